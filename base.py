@@ -1,19 +1,24 @@
 import asyncio
+import copy
 import json
 import logging
 import os
 import sys
-from datetime import datetime
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from enum import Enum
 from types import DynamicClassAttribute
 
-import aioredis
 from inquirer_utils.headers import CACHE_TTL, DEFAULT_SUBSYSTEMS
-from is74_utils import now
+from is74_utils import DateTimeEncoder, now, logger
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from inquirer_plugins.utils import DeviceException
-from inquirer_plugins.utils import check_lock, connect
+from inquirer_plugins.utils import LOCK_SIGNAL_TTL, check_lock, connect, redis_pools, wait_signal
 
 DEFAULT_RETRIES = 5
 DEFAULT_TIMEOUT = 10
@@ -22,6 +27,15 @@ DEFAULT_BYTE_ORDER = 'big'
 
 DEVICE_SUBMITTER = os.environ.get('DEVICE_SUBMITTER', 'DeviceSubmitter')
 
+SCHEME_CACHE_TTL = int(os.environ.get('SCHEME_CACHE_TTL', 24 * 60 * 60))
+CLOCK_OFFSET_TTL = int(os.environ.get('CLOCK_OFFSET_TTL', 60 * 60))
+CLOCK_DRIFT_MAX = int(os.environ.get('CLOCK_DRIFT_MAX', 60))
+
+CONFIG_CACHE_SIZE = int(os.environ.get('CONFIG_CACHE_SIZE', 10000))
+CONFIG_CACHE_TTL = int(os.environ.get('CONFIG_CACHE_TTL', 5 * 60))
+CONFIG_FLUSH_SIZE = int(os.environ.get('CONFIG_FLUSH_SIZE', 500))
+CONFIG_FLUSH_INTERVAL = float(os.environ.get('CONFIG_FLUSH_INTERVAL', 5))
+
 MONGO_DB = 'partner'
 MONGO_LOGIN = os.environ.get('MONGO_LOGIN')
 MONGO_PASSWORD = os.environ.get('MONGO_PASSWORD')
@@ -85,6 +99,241 @@ class DeviceEnum(Enum):
         return self.name.lower()
 
 
+# Захват блокировки или подтверждение владения ею, возвращает токен владения (0 - блокировка занята).
+# Токен отличает владельцев при продлении и снятии блокировки, получателями данных он не проверяется
+LOCK_ACQUIRE_SCRIPT = """
+local info = redis.call('GET', KEYS[1])
+
+if info then
+    info = cjson.decode(info)
+
+    if info['owner'] == ARGV[1] then
+        redis.call('PEXPIRE', KEYS[1], ARGV[3])
+        return info['token']
+    end
+
+    return 0
+end
+
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], cjson.encode({owner = ARGV[1], dev_id = ARGV[2], token = token}), 'PX', ARGV[3])
+
+return token
+"""
+
+# Продление блокировки, если она все еще выдана под этим токеном
+LOCK_RENEW_SCRIPT = """
+local info = redis.call('GET', KEYS[1])
+
+if info and cjson.decode(info)['token'] == tonumber(ARGV[1]) then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+
+return 0
+"""
+
+# Снятие блокировки и сигнал ожидающим
+LOCK_RELEASE_SCRIPT = """
+local info = redis.call('GET', KEYS[1])
+
+if info and cjson.decode(info)['token'] == tonumber(ARGV[1]) then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    redis.call('RPUSH', KEYS[2], 1)
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return 1
+end
+
+return 0
+"""
+
+
+def apply_config_update(config, update):
+    """
+    Применение $set-обновления (в том числе с ключами вида 'a.b') к словарю конфигурации
+    """
+    for key, value in update.items():
+        *path, field = key.split('.')
+        target = config
+
+        for part in path:
+            target = target.setdefault(part, {})
+
+        target[field] = value
+
+    return config
+
+
+def merge_config_update(pending, update):
+    """
+    Объединение $set-обновлений без конфликтов путей: родительский ключ заменяет отложенные
+    дочерние ('a' после 'a.b'), дочерний ключ записывается внутрь отложенного родителя ('a.b' после 'a')
+    """
+    for key, value in update.items():
+        for pending_key in [pending_key for pending_key in pending if pending_key.startswith(f'{key}.')]:
+            del pending[pending_key]
+
+        parts = key.split('.')
+
+        for idx in range(1, len(parts)):
+            parent = '.'.join(parts[:idx])
+
+            if parent in pending:
+                if not isinstance(pending[parent], dict):
+                    pending[parent] = {}
+
+                apply_config_update(pending[parent], {'.'.join(parts[idx:]): value})
+                break
+        else:
+            pending[key] = value
+
+    return pending
+
+
+class ConfigCache:
+    """
+    LRU-кэш конфигураций устройств из Mongo с ограниченным временем жизни записей
+    """
+
+    def __init__(self, max_size=CONFIG_CACHE_SIZE, ttl=CONFIG_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # dev_id -> (время устаревания, конфигурация)
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, dev_id):
+        item = self._items.get(dev_id)
+
+        if item is None:
+            return None
+
+        expires_at, config = item
+
+        if expires_at <= time.monotonic():
+            del self._items[dev_id]
+            return None
+
+        self._items.move_to_end(dev_id)
+
+        return copy.deepcopy(config)
+
+    def set(self, dev_id, config):
+        self._items[dev_id] = (time.monotonic() + self.ttl, config)
+        self._items.move_to_end(dev_id)
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def update(self, dev_id, update):
+        if dev_id in self._items:
+            apply_config_update(self._items[dev_id][1], copy.deepcopy(update))
+
+    def invalidate(self, dev_id=None):
+        if dev_id is None:
+            self._items.clear()
+        else:
+            self._items.pop(dev_id, None)
+
+
+class ConfigWriter:
+    """
+    Отложенная запись конфигураций устройств: обновления объединяются по dev_id
+    и записываются одним bulk_write по размеру буфера, по таймеру или при выходе из контекста
+    """
+
+    def __init__(self, collection, max_size=CONFIG_FLUSH_SIZE, interval=CONFIG_FLUSH_INTERVAL):
+        self.collection = collection
+        self.max_size = max_size
+        self.interval = interval
+
+        # dev_id -> объединенный $set
+        self._pending = {}
+        self._flush_lock = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def pending(self, dev_id):
+        return copy.deepcopy(self._pending.get(dev_id, {}))
+
+    async def write(self, dev_id, update):
+        merge_config_update(self._pending.setdefault(dev_id, {}), copy.deepcopy(update))
+
+        if len(self._pending) >= self.max_size:
+            await self.flush()
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        # Таймер запускается заново и из самого таймера, если его запись не удалась
+        if self._timer is None or self._timer.done() or self._timer is asyncio.current_task():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self, dev_ids=None, retry=True):
+        """
+        Запись накопленных обновлений (всех или только устройств dev_ids),
+        возвращает ошибки по устройствам {dev_id: ошибка}
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if dev_ids is None:
+                pending, self._pending = self._pending, {}
+            else:
+                pending = {dev_id: self._pending.pop(dev_id) for dev_id in dev_ids if dev_id in self._pending}
+
+            if not pending:
+                return {}
+
+            dev_ids = list(pending)
+            requests = [
+                UpdateOne({'dev_id': dev_id}, {'$set': update, '$setOnInsert': {'dev_id': dev_id}}, upsert=True)
+                for dev_id, update in pending.items()
+            ]
+            errors = {}
+
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    errors[dev_ids[error['index']]] = error.get('errmsg')
+            except Exception as e:
+                # Пакет не записан целиком - обновления возвращаются в буфер под более новые
+                for dev_id, update in pending.items():
+                    self._pending[dev_id] = merge_config_update(update, self._pending.get(dev_id, {}))
+                    errors[dev_id] = str(e)
+
+                if retry:
+                    self._schedule()
+
+            for dev_id, error in errors.items():
+                logger.error(f'{dev_id}: ошибка записи конфигурации: {error}')
+
+            return errors
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        return await self.flush(retry=False)
+
+
 class BaseProtocol:
 
     def __init__(self, dev_id=None):
@@ -102,13 +351,24 @@ class Base:
         self.dev_id = str(dev_id)
         self.lock_key = self.dev_id
 
+        self.lock_owner = uuid.uuid4().hex
+        self.lock_token = None
+        self.lock_depth = 0
+        self.lock_lost = False
+        self._lock_renewal = None
+
         self.func = func
         self.proc = proc
 
+        # metric_type -> event_time последней переданной записи
+        self.last_event_times = {}
+        # Результаты передачи пачек, поставленных в фоновую очередь
+        self.pending_submits = []
+
         self.loop = asyncio.get_event_loop()
 
     async def __aenter__(self):
-        self.cache = await aioredis.create_redis('redis://partner-redis/0')
+        self.cache = await redis_pools.get()
 
         await self._async_init(**self._kwargs)
 
@@ -118,9 +378,6 @@ class Base:
         self.func = None
         self.proc = None
 
-        self.cache.close()
-        await self.cache.wait_closed()
-
     async def _async_init(self, **kwargs):
         ...
 
@@ -141,15 +398,66 @@ class Base:
         return self.__get_callbacks(self.__class__)
 
     async def lock_connect(self):
-        info = json.dumps({
-            'id': id(self),
-            'dev_id': self.dev_id,
-        })
+        token = await self.cache.eval(
+            LOCK_ACQUIRE_SCRIPT,
+            keys=[f'locks:{self.lock_key}', f'locks:{self.lock_key}:token'],
+            args=[self.lock_owner, self.dev_id, CACHE_TTL * 1000]
+        )
+
+        if token:
+            self.lock_token = token
+            self.lock_lost = False
 
-        return await self.cache.set(f'locks:{self.lock_key}', info, expire=CACHE_TTL, exist=self.cache.SET_IF_NOT_EXIST)
+            if self._lock_renewal is None or self._lock_renewal.done():
+                self._lock_renewal = asyncio.ensure_future(self._renew_lock())
+
+        return token
+
+    async def _renew_lock(self):
+        while True:
+            await asyncio.sleep(CACHE_TTL / 3)
+
+            try:
+                renewed = await self.cache.eval(
+                    LOCK_RENEW_SCRIPT, keys=[f'locks:{self.lock_key}'], args=[self.lock_token, CACHE_TTL * 1000]
+                )
+            except Exception as e:
+                # Без подтверждения от Redis владение блокировкой не гарантировано
+                logger.error(f'{self.dev_id}: ошибка продления блокировки: {e}')
+                renewed = 0
+
+            if not renewed:
+                self.lock_lost = True
+                logger.error(f'{self.dev_id}: блокировка {self.lock_token} потеряна')
+                return
 
     async def unlock_connect(self):
-        await self.cache.delete(f'locks:{self.lock_key}')
+        if self._lock_renewal is not None:
+            self._lock_renewal.cancel()
+            self._lock_renewal = None
+
+        await self.cache.eval(
+            LOCK_RELEASE_SCRIPT,
+            keys=[f'locks:{self.lock_key}', f'locks:{self.lock_key}:released'],
+            args=[self.lock_token, LOCK_SIGNAL_TTL]
+        )
+
+        self.lock_token = None
+
+    async def confirm_submitted(self):
+        """
+        Ожидание передачи всех поставленных в очередь пачек, True - все переданы
+        """
+        pending, self.pending_submits = self.pending_submits, []
+
+        return all(await asyncio.gather(*pending))
+
+    def check_lease(self):
+        if self.lock_lost:
+            raise DeviceException(f'{self.dev_id}: блокировка устройства потеряна, данные не передаются')
+
+    async def wait_unlock(self, wait_time):
+        return await wait_signal(f'locks:{self.lock_key}:released', wait_time)
 
     async def get_lock_info(self):
         info = await self.cache.get(f'locks:{self.lock_key}')
@@ -187,8 +495,13 @@ class BaseDevice(Base):
 
     CALC_METRICS = []
 
+    # Поля схемы, которые не меняются между опросами и хранятся в общем кэше
+    SCHEME_STATIC_FIELDS = ('serial', 'subsystems', 'report_day')
+
     __mdb_connection = AsyncIOMotorClient(MONGO_URL)
     __mdb = __mdb_connection[MONGO_DB]
+    __config_cache = ConfigCache()
+    __config_writer = ConfigWriter(__mdb['configs'])
 
     def __init__(self, dev_id, **kwargs):
         super().__init__(dev_id, **kwargs)
@@ -196,6 +509,22 @@ class BaseDevice(Base):
         self._scheme = {}
         self.is_opened = False
 
+        # Вне общего цикла опроса отложенные обновления конфигурации записываются при выходе из контекста
+        self.flush_config_on_exit = True
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.flush_config_on_exit:
+            await self.__config_writer.flush([self.dev_id])
+
+        await super().__aexit__(exc_type, exc_val, exc_tb)
+
+    @property
+    def report_day(self):
+        """
+        Расчетный день из уже полученной схемы, без обращения к устройству
+        """
+        return self._scheme.get('report_day', 31)
+
     @staticmethod
     async def _get_scheme():
         return {
@@ -203,27 +532,133 @@ class BaseDevice(Base):
         }
 
     async def get_scheme(self):
+        if not self._scheme:
+            self._scheme = await self._get_cached_scheme()
+
         if not self._scheme:
             self._scheme = await self._get_scheme()
+            await self._set_cached_scheme(self._scheme)
 
         return self._scheme
 
+    @property
+    def scheme_key(self):
+        return f'schemes:{self.dev_id}'
+
+    async def _get_cached_scheme(self):
+        """
+        Схема из общего кэша. Время прибора вычисляется по сохраненному смещению часов,
+        при устаревшем смещении прибор опрашивается заново
+        """
+        if getattr(self, 'cache', None) is None:
+            return None
+
+        cached = await self.cache.get(self.scheme_key)
+
+        if not cached:
+            return None
+
+        cached = json.loads(cached)
+        scheme = cached['scheme']
+
+        if 'clock_offset' in cached:
+            if now().timestamp() - cached['measured_at'] > CLOCK_OFFSET_TTL:
+                return None
+
+            current_time = now() + timedelta(seconds=cached['clock_offset'])
+            scheme['current_time'] = current_time.replace(second=0, microsecond=0)
+
+        return scheme
+
+    async def _set_cached_scheme(self, scheme):
+        if getattr(self, 'cache', None) is None:
+            return
+
+        cached = {
+            'scheme': {key: value for key, value in scheme.items() if key in self.SCHEME_STATIC_FIELDS},
+        }
+
+        if 'current_time' in scheme:
+            measured_at = now()
+            clock_offset = (scheme['current_time'] - measured_at).total_seconds()
+
+            previous = await self.cache.get(self.scheme_key)
+            previous = json.loads(previous) if previous else {}
+
+            if 'clock_offset' in previous and abs(previous['clock_offset'] - clock_offset) > CLOCK_DRIFT_MAX:
+                logger.warning(f'{self.dev_id}: уход часов прибора {clock_offset - previous["clock_offset"]:.0f} сек')
+
+            cached['clock_offset'] = clock_offset
+            cached['measured_at'] = measured_at.timestamp()
+
+        await self.cache.set(self.scheme_key, json.dumps(cached, cls=DateTimeEncoder), expire=SCHEME_CACHE_TTL)
+
+    async def clear_cached_scheme(self):
+        self._scheme = {}
+
+        if getattr(self, 'cache', None) is not None:
+            await self.cache.delete(self.scheme_key)
+
     @property
     async def mdb_config(self):
-        return await self.__mdb['configs'].find_one({'dev_id': self.dev_id}) or {}
+        config = self.__config_cache.get(self.dev_id)
+
+        if config is None:
+            config = await self.__mdb['configs'].find_one({'dev_id': self.dev_id}) or {}
+            self.__config_cache.set(self.dev_id, copy.deepcopy(config))
+
+        # Еще не записанные в Mongo обновления
+        return apply_config_update(config, self.__config_writer.pending(self.dev_id))
+
+    @classmethod
+    async def prefetch_configs(cls, dev_ids):
+        """
+        Загрузка конфигураций для пачки устройств одним запросом
+        """
+        configs = {str(dev_id): {} for dev_id in dev_ids}
+
+        async for config in cls.__mdb['configs'].find({'dev_id': {'$in': list(configs)}}):
+            configs[config['dev_id']] = config
+
+        for dev_id, config in configs.items():
+            cls.__config_cache.set(dev_id, config)
+
+    @classmethod
+    async def watch_configs(cls):
+        """
+        Сброс кэша конфигураций по изменениям в Mongo (требуется replica set)
+        """
+        async with cls.__mdb['configs'].watch(full_document='updateLookup') as stream:
+            async for change in stream:
+                document = change.get('fullDocument') or {}
+                cls.__config_cache.invalidate(document.get('dev_id'))
 
     async def set_mdb_config(self, config: dict):
         if 'dev_id' in config:
             del config['dev_id']
 
-        await self.__mdb['configs'].update_one(
-            {'dev_id': self.dev_id},
-            {
-                '$set': config,
-                '$setOnInsert': {'dev_id': self.dev_id}
-            },
-            upsert=True
-        )
+        await self.__config_writer.write(self.dev_id, config)
+
+        self.__config_cache.update(self.dev_id, config)
+
+    async def get_cursor(self, metric_type):
+        """
+        Позиция, до которой архив metric_type уже прочитан и передан
+        """
+        return (await self.mdb_config).get('cursors', {}).get(metric_type)
+
+    async def set_cursor(self, metric_type, **cursor):
+        await self.set_mdb_config({f'cursors.{metric_type}': {**cursor, 'updated': now()}})
+
+    async def clear_cursors(self):
+        await self.set_mdb_config({'cursors': {}})
+
+    @classmethod
+    async def flush_configs(cls):
+        """
+        Запись всех отложенных обновлений конфигураций, вызывается при завершении работы
+        """
+        return await cls.__config_writer.close()
 
     @staticmethod
     async def open():
@@ -244,10 +679,13 @@ class BaseDevice(Base):
 
     @check_lock
     @connect
-    async def process_metrics(self, last_dates: [dict, datetime] = None):
+    async def process_metrics(self, last_dates: [dict, datetime] = None, metric_types: list = None):
         config = await self.get_config()
 
         for metric_type, use_last_date in config['data_availability']:
+            if metric_types is not None and metric_type not in metric_types:
+                continue
+
             params = {}
 
             if use_last_date:
@@ -273,6 +711,10 @@ class BaseDevice(Base):
     async def reload_metrics(self, clear_metrics=0, clear_conf=0):
         if clear_metrics:
             await self.func(DEVICE_SUBMITTER, 'clear', dev_id=self.dev_id, need_clear_conf=clear_conf)
+            await self.clear_cursors()
+
+        if clear_conf:
+            await self.clear_cached_scheme()
 
         await self.process_metrics(last_dates=None)
 
@@ -0,0 +1,61 @@
+"""
+Сравнение отсечения записей по last_date на ответе из 10 000 почасовых записей:
+прежний цикл с list.remove, проход по списку и бинарный поиск для упорядоченных данных.
+
+    python benchmarks/bench_filter_last_date.py [--records 10000] [--repeat 20]
+"""
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+from inquirer_plugins.utils import filter_last_date
+
+
+def make_data(count):
+    started = datetime(2020, 1, 1)
+
+    return [
+        {'metric_type': 'integral_hour', 'event_time': started + timedelta(hours=idx), 'metrics': {'1': {}}}
+        for idx in range(count)
+    ]
+
+
+def remove_loop(data, last_date):
+    """
+    Прежняя реализация из submit_response: O(n^2) и пропуск каждой второй устаревшей записи
+    """
+    for item in data:
+        if item['event_time'] > last_date:
+            break
+
+        data.remove(item)
+
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    data = make_data(args.records)
+    # Граница посередине ответа: половина записей уже передана
+    last_date = data[len(data) // 2 - 1]['event_time']
+
+    cases = {
+        'remove loop': lambda: remove_loop(list(data), last_date),
+        'single pass': lambda: filter_last_date(data, last_date),
+        'bisect': lambda: filter_last_date(data, last_date, is_sorted=True),
+    }
+
+    expected = len(data) - len(data) // 2
+    print(f'{args.records} records, {expected} newer than last_date')
+
+    for name, case in cases.items():
+        elapsed = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print(f'{name:>12}: {elapsed * 1000:9.3f} ms, {len(case())} records left')
+
+
+if __name__ == '__main__':
+    main()
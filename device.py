@@ -1,14 +1,29 @@
 import asyncio
 import logging
 import os
+import re
 import struct
 from datetime import datetime
 
 from inquirer_plugins.meter_types import NetDevice
 from inquirer_plugins.devices.teplocon_01.headers import *
-from inquirer_plugins.utils import check_lock, submit_response, connect, check_response, wrap_response
+from inquirer_utils import delta
+from inquirer_plugins.utils import check_lock, submit_response, connect, check_response, wrap_response, connection_pool
 from is74_utils import now
 
+try:
+    from crcmod.predefined import mkPredefinedCrcFun
+except ImportError:
+    mkPredefinedCrcFun = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Разбор архивов в структурированные массивы NumPy
+NUMPY_ARCHIVES = bool(os.environ.get('NUMPY_ARCHIVES', False)) and np is not None
+
 
 class Crc16Exception(Exception):
     def __init__(self, message):
@@ -31,43 +46,445 @@ class IncorrectRequest(Exception):
         self.message = message
 
 
+class ResponseTimeoutException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
 class IncorrectArchDate(Exception):
     def __init__(self, message):
         self.message = message
 
 
+def _make_crc16_table():
+    table = []
+
+    for item in range(256):
+        crc = item
+        for count in range(8):
+            crc = (crc >> 1) ^ CRC16_POLY if crc & 0x1 else crc >> 1
+        table.append(crc)
+
+    return tuple(table)
+
+
+CRC16_TABLE = _make_crc16_table()
+
+# Ускоренный расчет через C-расширение crcmod, если оно установлено
+_crc16_native = mkPredefinedCrcFun('modbus') if mkPredefinedCrcFun else None
+
+
+class Crc16:
+    """
+    Табличный расчет CRC16/MODBUS с поддержкой потоковых данных
+    """
+    __slots__ = ('crc',)
+
+    def __init__(self, data=b''):
+        self.crc = CRC16_INIT
+
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        if _crc16_native is not None:
+            self.crc = _crc16_native(data if isinstance(data, bytes) else bytes(data), self.crc)
+            return self
+
+        crc = self.crc
+        table = CRC16_TABLE
+
+        for item in data if not isinstance(data, memoryview) else data.cast('B'):
+            crc = (crc >> 8) ^ table[(crc ^ item) & 0xFF]
+
+        self.crc = crc
+        return self
+
+    def digest(self):
+        return self.crc.to_bytes(2, 'little')
+
+    def check(self):
+        # CRC кадра вместе с его контрольной суммой равен нулю
+        return self.crc == 0
+
+
+def crc16(data):
+    return Crc16(data).digest()
+
+
+# Таблицы 7-битного кодирования с битом четности
+PARITY_ENCODE_TABLE = bytes(byte | 0x80 if bin(byte).count('1') % 2 else byte for byte in range(256))
+PARITY_DECODE_TABLE = bytes(byte if bin(byte).count('1') % 2 else byte & 0x7F for byte in range(256))
+
+
+class ParityStreamReader:
+    """
+    Обертка над asyncio.StreamReader, снимающая бит четности с принятых данных
+    """
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    async def read(self, n=-1):
+        return (await self._reader.read(n)).translate(PARITY_DECODE_TABLE)
+
+    async def readexactly(self, n):
+        return (await self._reader.readexactly(n)).translate(PARITY_DECODE_TABLE)
+
+    def __getattr__(self, item):
+        return getattr(self._reader, item)
+
+
+class ParityStreamWriter:
+    """
+    Обертка над asyncio.StreamWriter, добавляющая бит четности к отправляемым данным
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def write(self, data):
+        self._writer.write(bytes(data).translate(PARITY_ENCODE_TABLE))
+
+    def __getattr__(self, item):
+        return getattr(self._writer, item)
+
+
+# Соответствие кодов struct типам NumPy (little-endian)
+STRUCT_DTYPES = {
+    'b': '<i1', 'B': '<u1',
+    'h': '<i2', 'H': '<u2',
+    'l': '<i4', 'L': '<u4',
+    'f': '<f4',
+}
+
+
+class RecordCodec:
+    """
+    Предкомпилированная структура записи ответа прибора
+    """
+
+    def __init__(self, fmt, keys):
+        self.struct = struct.Struct(f'<{fmt}')
+        self.keys = tuple(keys)
+        self.size = self.struct.size
+        self.fmt = fmt
+        self.dtype = None
+
+    @staticmethod
+    def make_dtype(fmt, keys):
+        codes = []
+
+        for count, code in re.findall(r'(\d*)(\w)', fmt):
+            codes += [STRUCT_DTYPES[code]] * int(count or 1)
+
+        return np.dtype(list(zip(keys, codes)))
+
+    def unpack(self, raw):
+        return self.struct.unpack(raw)
+
+    def iter_items(self, raw):
+        return zip(self.keys, self.struct.unpack(raw))
+
+    def iter_dicts(self, raw):
+        keys = self.keys
+        return [dict(zip(keys, values)) for values in self.struct.iter_unpack(raw)]
+
+    def to_array(self, raw):
+        if self.dtype is None:
+            self.dtype = self.make_dtype(self.fmt, self.keys)
+
+        return np.frombuffer(raw, dtype=self.dtype)
+
+
+SETTINGS_CODEC = RecordCodec(STRUCT_SETTINGS, COMMON_DATA_STRUCT[SETTINGS])
+STAT_TIME_CODEC = RecordCodec(STRUCT_STAT_TIME, COMMON_DATA_STRUCT[STAT_TIME])
+CURRENT_CODEC = RecordCodec(STRUCT_CURRENT, COMMON_DATA_STRUCT[INTEGRAL_CURRENT] + COMMON_DATA_STRUCT[PERIOD_CURRENT])
+ADDITIONAL_CODEC = RecordCodec(
+    STRUCT_ADDITIONAL, COMMON_DATA_STRUCT[INTEGRAL_ADDITIONAL] + COMMON_DATA_STRUCT[PERIOD_ADDITIONAL]
+)
+ARCH_CODEC = RecordCodec(STRUCT_ARCH, COMMON_DATA_STRUCT[INTEGRAL_HOUR])
+
+
+class GatewaySession:
+    """
+    Общее TCP-соединение с преобразователем интерфейсов (ip:port).
+    Запросы всех приборов за преобразователем выполняются по очереди через одно соединение
+    """
+    _sessions = {}
+
+    def __init__(self, ip, port, parity=False, cache_ttl=REQUEST_CACHE_TTL):
+        self.ip = ip
+        self.port = port
+        self.parity = parity
+        self.cache_ttl = cache_ttl
+
+        self.reader, self.writer = None, None
+        self.users = 0
+        self.broken = False
+
+        self._queue = asyncio.Queue()
+        self._open_lock = asyncio.Lock()
+        self._worker = None
+
+        # Кэш ответов сессии: запрос -> (время устаревания, future)
+        self._responses = {}
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def get(cls, ip, port, parity=False):
+        key = (ip, port)
+
+        if key not in cls._sessions:
+            cls._sessions[key] = cls(ip, port, parity)
+
+        return cls._sessions[key]
+
+    @property
+    def is_opened(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def acquire(self):
+        self.users += 1
+
+        try:
+            async with self._open_lock:
+                if self._worker is None:
+                    await self._open()
+        except Exception:
+            await self.release()
+            raise
+
+        return self
+
+    async def release(self):
+        self.users -= 1
+
+        if self.users <= 0:
+            await self.close()
+
+    async def _open(self):
+        await self._connect()
+        self._worker = asyncio.ensure_future(self._process_queue())
+
+    async def _connect(self):
+        self.reader, self.writer = self._streams = await connection_pool.lease(self.ip, self.port)
+        self.broken = False
+
+        if self.parity:
+            self.reader, self.writer = ParityStreamReader(self.reader), ParityStreamWriter(self.writer)
+
+    def _discard(self):
+        """
+        После таймаута или сбоя кадра в потоке может остаться поздний ответ, который был бы принят
+        за ответ на следующий запрос (в том числе к другому прибору). Соединение закрывается,
+        следующий запрос очереди выполняется через новое
+        """
+        self.broken = True
+
+        if self.writer is not None:
+            connection_pool.release(self.ip, self.port, *self._streams, reuse=False)
+            self.reader, self.writer = None, None
+
+    async def close(self):
+        if self._sessions.get((self.ip, self.port)) is self:
+            del self._sessions[(self.ip, self.port)]
+
+        if self._worker:
+            worker, self._worker = self._worker, None
+            worker.cancel()
+
+            # Прерванный обмен закрывает соединение, оно не возвращается в пул
+            await asyncio.gather(worker, return_exceptions=True)
+
+        while not self._queue.empty():
+            *_, future = self._queue.get_nowait()
+            future.cancel()
+
+        if self.writer:
+            # Исправное соединение возвращается в пул для следующего опроса
+            connection_pool.release(self.ip, self.port, *self._streams, reuse=not self.broken)
+            self.reader, self.writer = None, None
+
+    async def request(self, func, *args):
+        """
+        Постановка обмена с прибором в очередь соединения
+        """
+        if self._worker is None:
+            raise ConnectionError(f'{self.ip}:{self.port}: Connection is closed')
+
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((func, args, future))
+
+        return await future
+
+    async def cached_request(self, key, func, *args):
+        """
+        Запрос с кэшированием ответа на cache_ttl секунд.
+        Одновременные одинаковые запросы объединяются в один обмен с прибором
+        """
+        loop_time = asyncio.get_event_loop().time()
+
+        for cached_key, (expires_at, cached) in list(self._responses.items()):
+            if cached.done() and expires_at <= loop_time:
+                del self._responses[cached_key]
+
+        if key in self._responses:
+            return await asyncio.shield(self._responses[key][1])
+
+        future = asyncio.ensure_future(func(*args))
+        self._responses[key] = (loop_time + self.cache_ttl, future)
+
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            if key in self._responses and self._responses[key][1] is future:
+                del self._responses[key]
+            raise
+
+    async def _process_queue(self):
+        while True:
+            func, args, future = await self._queue.get()
+
+            if future.done():
+                continue
+
+            try:
+                if not self.is_opened:
+                    await self._connect()
+
+                result = await func(*args)
+            except asyncio.CancelledError:
+                self._discard()
+                raise
+            except Exception as e:
+                self._discard()
+                self._resolve(future, exception=e)
+            else:
+                self._resolve(future, result)
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        # Запрос мог быть отменен, пока шел обмен: ответ отбрасывается, очередь продолжает работу
+        if future.done():
+            return
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+class LinkQuality:
+    """
+    Качество связи с прибором: задержка ответа (SRTT/RTTVAR по RFC 6298), скорость передачи
+    и доля кадров со сбоем CRC. Определяет таймауты ответа и размер страницы архива
+    """
+    FIELDS = ('srtt', 'rttvar', 'throughput', 'crc_rate', 'frame_len', 'samples')
+
+    def __init__(self, speed=9600, srtt=None, rttvar=None, throughput=None, crc_rate=0.0, frame_len=0.0, samples=0):
+        self.srtt = srtt
+        self.rttvar = rttvar
+        # Без измерений скорость определяется скоростью линии (10 бит на байт)
+        self.throughput = throughput or speed / 10
+        self.crc_rate = crc_rate
+        self.frame_len = frame_len
+        self.samples = samples
+
+        self.rto = None
+        self.changed = False
+
+        if srtt is not None:
+            self._update_rto()
+
+    @classmethod
+    def from_dict(cls, data, speed=9600):
+        return cls(speed, **{key: value for key, value in (data or {}).items() if key in cls.FIELDS})
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def _update_rto(self):
+        rto = self.srtt + max(LINK_RTT_GRANULARITY, LINK_RTT_K * self.rttvar)
+        self.rto = min(max(rto, LINK_RTO_MIN), LINK_RTO_MAX)
+
+    def observe(self, latency, length, duration):
+        """
+        Ответ получен: latency - ожидание заголовка, length байт остатка кадра за duration сек
+        """
+        if self.srtt is None:
+            self.srtt, self.rttvar = latency, latency / 2
+        else:
+            self.rttvar = (1 - LINK_RTT_BETA) * self.rttvar + LINK_RTT_BETA * abs(self.srtt - latency)
+            self.srtt = (1 - LINK_RTT_ALPHA) * self.srtt + LINK_RTT_ALPHA * latency
+
+        self._update_rto()
+
+        # Остаток кадра, пришедший одним пакетом с заголовком, о скорости линии не говорит
+        if length and duration > LINK_RTT_GRANULARITY:
+            self.throughput = (1 - LINK_EWMA) * self.throughput + LINK_EWMA * length / duration
+
+        self.samples += 1
+        self.changed = True
+
+    def observe_frame(self, length, valid):
+        self.crc_rate = (1 - LINK_EWMA) * self.crc_rate + LINK_EWMA * (0.0 if valid else 1.0)
+        self.frame_len = (1 - LINK_EWMA) * self.frame_len + LINK_EWMA * length if self.frame_len else length
+        self.changed = True
+
+    def backoff(self, timeout):
+        """
+        Экспоненциальное увеличение таймаута после потери ответа, до следующего измерения.
+        Без измерений удваивается действовавший таймаут timeout: иначе при задержке канала больше
+        таймаута по умолчанию ответ не дождаться и оценка связи не получит ни одного измерения
+        """
+        self.rto = min((self.rto if self.rto is not None else timeout) * 2, LINK_RTO_MAX)
+        self.changed = True
+
+    def body_timeout(self, length):
+        return 2 * length / self.throughput + LINK_RTT_K * self.rttvar
+
+    def page_size(self):
+        """
+        Число записей страницы архива: передача не дольше LINK_PAGE_TIME
+        и не более LINK_PAGE_ERRORS ожидаемых сбоев CRC на страницу
+        """
+        if not self.samples:
+            return ARCH_PAGE_SIZE
+
+        size = self.throughput * LINK_PAGE_TIME / ARCH_LEN
+
+        if self.crc_rate > 0:
+            # Доля сбоев на байт оценивается по средней длине кадра
+            size = min(size, LINK_PAGE_ERRORS * self.frame_len / (self.crc_rate * ARCH_LEN))
+
+        return min(max(int(size), 1), ARCH_MAX_PAGE_SIZE)
+
+
 class TeploconCommon:
     _reader, _writer = None, None
+    _session = None
 
-    def __init__(self, ip, port, boudrate=9600, timeout=DEFAULT_TIMEOUT):
+    def __init__(self, ip, port, boudrate=9600, timeout=DEFAULT_TIMEOUT, parity=False):
         self.ip = ip
         self.port = int(port)
 
         self.boudrate = BOUDRATES.get(boudrate, 0x35)
+        self.speed = boudrate if boudrate in BOUDRATES else 9600
         self.timeout = timeout
+        self.parity = parity
         self.is_opened = False
 
+        self.link = LinkQuality(self.speed)
+
         self._service_name = os.environ.get('SERVICE_NAME', self.__class__.__name__)
         self.log = logging.getLogger(self._service_name)
         self.loop = asyncio.get_event_loop()
 
     @staticmethod
     def compute_crc(data):
-        crc = 0xffff
-
-        for item in data:
-            crc = crc ^ item
-            for count in range(8):
-                if crc & 0x1:
-                    mask = 0xa001
-                else:
-                    mask = 0x00
-                crc = ((crc >> 1) & 0x7FFF) ^ mask
-
-        if crc < 0:
-            crc -= 256
-
-        return chr(crc & 0xFF).encode('latin-1') + chr((crc >> 8) & 0xFF).encode('latin-1')
+        return crc16(data)
 
     @staticmethod
     def join_cmd(*args):
@@ -89,51 +506,106 @@ class TeploconCommon:
 
     @staticmethod
     def decode(data):
-        buffer = []
-
-        for byte in data:
-            buffer.append(byte if bin(byte)[1:].count('1') % 2 else byte & 0x7F)
-
-        return bytes(buffer)
+        return bytes(data).translate(PARITY_DECODE_TABLE)
 
     @staticmethod
     def encode(data):
-        buffer = []
-
-        for byte in data:
-            buffer.append(byte | 0x80 if bin(byte).count('1') % 2 else byte)
-
-        return bytes(buffer)
+        return bytes(data).translate(PARITY_ENCODE_TABLE)
 
     async def form_cmd_async(self, *args):
         buffer = b''
 
         buffer += bytes(self.join_cmd(*args))
-        buffer += bytes(self.compute_crc(buffer))
+        buffer += self.compute_crc(buffer)
 
         return buffer
 
-    async def send_async(self, data):
-        if not self._writer.is_closing():
+    async def send_async(self, data, length=None):
+        if self._session is not None:
+            return await self._session.request(self._exchange, data, length)
+
+        return await self._exchange(data, length)
+
+    @property
+    def streams(self):
+        # Сессия заменяет потоки общего соединения после сбоя обмена
+        if self._session is not None:
+            return self._session.reader, self._session.writer
+
+        return self._reader, self._writer
+
+    async def _exchange(self, data, length=None):
+        _, writer = self.streams
+
+        if not writer.is_closing():
             # self.log.info(f'Send: {data!r}')
-            self._writer.write(data)
-            await self._writer.drain()
-            return await self.receive_async()
+            writer.write(data)
+
+            try:
+                await asyncio.wait_for(writer.drain(), LINK_RTO_MAX)
+            except asyncio.TimeoutError:
+                raise ResponseTimeoutException(f'_exchange: Request of {len(data)} bytes is not sent')
+
+            return await self.receive_async(length)
 
         self.log.info('Sending failed')
 
-    async def receive_async(self):
-        return await self._reader.read(BUFFER_SIZE)
+    def frame_timeout(self, length):
+        # Пауза перед ответом прибора + время передачи кадра по линии (10 бит на байт)
+        return LONG_RESPONSE_TIMEOUT + length * 10 / self.speed
+
+    def reply_timeout(self):
+        if self.link.rto is not None:
+            return self.link.rto
+
+        return self.timeout + self.frame_timeout(FRAME_HEADER_LEN)
+
+    def body_timeout(self, length):
+        if self.link.samples:
+            return self.link.body_timeout(length - FRAME_HEADER_LEN) + LINK_RTO_MIN
+
+        return self.frame_timeout(length)
+
+    async def receive_async(self, length=None):
+        reader, _ = self.streams
+
+        if length is None:
+            return await reader.read(BUFFER_SIZE)
+
+        started = self.loop.time()
+        reply_timeout = self.reply_timeout()
+
+        try:
+            header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER_LEN), reply_timeout)
+            received = self.loop.time()
+
+            body = await asyncio.wait_for(reader.readexactly(length - FRAME_HEADER_LEN), self.body_timeout(length))
+        except asyncio.TimeoutError:
+            self.link.backoff(reply_timeout)
+            raise ResponseTimeoutException(f'receive_async: No complete response of {length} bytes')
+        except asyncio.IncompleteReadError as e:
+            raise ResponseParseException(f'receive_async: Connection closed after {len(e.partial)} bytes')
+
+        self.link.observe(received - started, length - FRAME_HEADER_LEN, self.loop.time() - received)
+
+        return header + body
 
     async def close_async(self):
-        self.log.info('Close the connection')
-        self._writer.close()
         self.is_opened = False
 
-        await self._writer.wait_closed()
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.release()
+            return
+
+        connection_pool.release(self.ip, self.port, self._reader, self._writer)
 
 
 class Device(NetDevice, TeploconCommon):
+    # (dev_id, архив) -> (номер последней записанной записи, ее wN_arc)
+    _archive_heads = {}
+    # (dev_id, архив) -> (номер записи, время ее периода), подтвержденные часами прибора
+    _archive_anchors = {}
 
     def __init__(self, **kwargs):
 
@@ -160,27 +632,36 @@ class Device(NetDevice, TeploconCommon):
 
         self.funcs_and_commands_table = {
 
-            'read_settings': [self._parse_settings, CMD_READ_SETTINGS],
-            'read_stat_time': [self._parse_stat_time, CMD_READ_STAT_TIME],
+            'read_settings': [self._parse_settings, CMD_READ_SETTINGS, SETTINGS_CODEC],
+            'read_stat_time': [self._parse_stat_time, CMD_READ_STAT_TIME, STAT_TIME_CODEC],
 
-            'read_current': [self._parse_current, CMD_READ_CUR_PARAMS],
-            'read_additional': [self._parse_additional, CMD_READ_ADD_PARAMS],
+            'read_current': [self._parse_current, CMD_READ_CUR_PARAMS, CURRENT_CODEC],
+            'read_additional': [self._parse_additional, CMD_READ_ADD_PARAMS, ADDITIONAL_CODEC],
 
-            'read_arch_month': [self._parse_month, CMD_READ_MONTH_ARCH],
-            'read_arch_day': [self._parse_day, CMD_READ_DAY_ARCH],
-            'read_arch_hour': [self._parse_hour, CMD_READ_HOUR_ARCH],
+            'read_arch_month': [self._parse_archive, CMD_READ_MONTH_ARCH, ARCH_CODEC],
+            'read_arch_day': [self._parse_archive, CMD_READ_DAY_ARCH, ARCH_CODEC],
+            'read_arch_hour': [self._parse_archive, CMD_READ_HOUR_ARCH, ARCH_CODEC],
 
-            'scan_arch_month': [self._parse_month, CMD_SCAN_MONTH_ARCH],
-            'scan_arch_day': [self._parse_day, CMD_SCAN_DAY_ARCH],
-            'scan_arch_hour': [self._parse_hour, CMD_SCAN_HOUR_ARCH],
+            'scan_arch_month': [self._parse_archive, CMD_SCAN_MONTH_ARCH, ARCH_CODEC],
+            'scan_arch_day': [self._parse_archive, CMD_SCAN_DAY_ARCH, ARCH_CODEC],
+            'scan_arch_hour': [self._parse_archive, CMD_SCAN_HOUR_ARCH, ARCH_CODEC],
         }
 
     async def open(self):
-        self._reader, self._writer = await asyncio.open_connection(self.ip, self.port)
+        self._session = await GatewaySession.get(self.ip, self.port, self.parity).acquire()
+
+        self.link = LinkQuality.from_dict((await self.mdb_config).get('link_quality'), self.speed)
         self.is_opened = True
 
         return self.is_opened
 
+    async def close_async(self):
+        if self.link.changed:
+            await self.set_mdb_config({'link_quality': self.link.to_dict()})
+            self.link.changed = False
+
+        await super().close_async()
+
     async def _get_scheme(self):
         settings = await self.read_metrics(0, type_metrics='read_settings')
         return {
@@ -190,12 +671,6 @@ class Device(NetDevice, TeploconCommon):
             'subsystems': DEFAULT_SUBSYSTEMS
         }
 
-    async def get_scheme(self):
-        if not self._scheme:
-            self._scheme = await self._get_scheme()
-
-        return self._scheme
-
     async def get_config(self):
         return {
             'data_availability': [
@@ -224,37 +699,202 @@ class Device(NetDevice, TeploconCommon):
             return 0
         return ((last_date.year - 2000) * 12 + last_date.month - 1) % 50
 
-    def eval_num_page(self, last_num_page):
-        now_num_page = self.get_narc(now())
+    @staticmethod
+    def months_between(since, until):
+        return (until.year - since.year) * 12 + until.month - since.month
+
+    async def read_wn(self, archive, narc, count=1):
+        """
+        Признаки записи wN_arc для count записей архива начиная с narc
+        """
+        records = await self.read_metrics(3, narc & 255, narc >> 8, count, type_metrics=f'scan_arch_{archive}')
+        return [record[WN_ARC] for record in records]
+
+    async def locate_archive_head(self, archive):
+        """
+        Номер последней записанной записи кольцевого архива, None для пустого архива.
+        Записи с wN_arc не меньше, чем у записи 0, идут подряд от начала буфера до последней записанной,
+        поэтому она находится двоичным поиском за log2(N) запросов
+        """
+        size = ARCH_SIZES[archive]
+        key = (self.dev_id, archive)
+
+        if key in self._archive_heads:
+            head, wn = self._archive_heads[key]
+            wn_head, wn_next = await self._read_head_pair(archive, head, size)
+
+            # Запись на месте и следующая за ней не новее: позиция из кэша актуальна
+            if wn_head == wn and wn_next <= wn:
+                return head
+
+        wn_first, = await self.read_wn(archive, 0)
 
-        if now_num_page - last_num_page < 0:
-            raise IncorrectArchDate('eval_num_page: Incorrect las_date')
+        if wn_first == 0:
+            self._archive_heads.pop(key, None)
+            return None
+
+        head, wn = 0, wn_first
+        hi = size - 1
+
+        while head < hi:
+            mid = (head + hi + 1) // 2
+            wn_mid, = await self.read_wn(archive, mid)
+
+            if wn_mid != 0 and wn_mid >= wn_first:
+                head, wn = mid, wn_mid
+            else:
+                hi = mid - 1
 
-        return now_num_page - last_num_page
+        self._archive_heads[key] = (head, wn)
+
+        return head
+
+    async def _read_head_pair(self, archive, head, size):
+        if head + 1 < size:
+            return await self.read_wn(archive, head, 2)
+
+        return (await self.read_wn(archive, head)) + (await self.read_wn(archive, 0))
+
+    @staticmethod
+    def arch_size(type_metrics):
+        return ARCH_SIZES[type_metrics.rsplit('_', 1)[-1]]
 
     async def read_metrics(self, *args, type_metrics=None):
         if not type_metrics:
             raise IncorrectRequest('read_metrics: Variable type_metrics is None')
 
+        response = await self.read_raw(*args, type_metrics=type_metrics)
+
+        return self.funcs_and_commands_table[type_metrics][0](response, args)
+
+    async def read_raw(self, *args, type_metrics=None):
+        if not type_metrics:
+            raise IncorrectRequest('read_raw: Variable type_metrics is None')
+
         raw = await self.form_cmd_async(self.dev_num, self.funcs_and_commands_table[type_metrics][1], list(args))
-        response = await self.send_async(raw)
+        length = self.frame_length(type_metrics, args)
+
+        if self._session is not None:
+            return await self._session.cached_request(raw, self._request_frame, raw, length)
+
+        return await self._request_frame(raw, length)
+
+    async def _request_frame(self, raw, length):
+        if self._session is not None:
+            return await self._session.request(self._exchange_frame, raw, length)
+
+        return await self._exchange_frame(raw, length)
+
+    async def _exchange_frame(self, raw, length):
+        """
+        Обмен с проверкой ответа. В сессии выполняется в ее очереди,
+        поэтому неверный ответ закрывает соединение до следующего запроса
+        """
+        frame = await self._exchange(raw, length)
 
-        return self._parse_metrics(type_metrics, response, args)
+        try:
+            response = self._check_frame(frame, raw)
+        except Crc16Exception:
+            self.link.observe_frame(len(frame), valid=False)
+            raise
 
-    def _parse_metrics(self, func, raw, args):
+        self.link.observe_frame(len(frame), valid=True)
+
+        return response
+
+    def frame_length(self, type_metrics, args):
+        """
+        Ожидаемая длина ответа: заголовок, данные (N записей для архивов) и CRC
+        """
+        codec = self.funcs_and_commands_table[type_metrics][2]
+        count = args[3] if codec is ARCH_CODEC else 1
+
+        return FRAME_HEADER_LEN + codec.size * count + FRAME_CRC_LEN
+
+    @staticmethod
+    def _check_frame(raw, request):
         if not raw:
-            raise ResponseParseException('_parse_metrics: Empty string')
+            raise ResponseParseException('_check_frame: Empty string')
+
+        if not Crc16(raw).check():
+            raise Crc16Exception('_check_frame: Checksum is incorrect')
+
+        # Заголовок ответа повторяет адрес прибора и код команды запроса
+        if raw[0] != request[0] or raw[1] != request[1]:
+            raise ResponseParseException(
+                f'_check_frame: Response {raw[0]}/{raw[1]:#04x} to request {request[0]}/{request[1]:#04x}'
+            )
+
+        return memoryview(raw)[FRAME_HEADER_LEN:-FRAME_CRC_LEN]
+
+    async def iter_archive(self, type_metrics, narc, count, page_size=None, as_array=NUMPY_ARCHIVES,
+                           event_time=None, step=None):
+        """
+        Постраничное чтение архива, для каждой страницы возвращает номер следующей за ней записи и записи.
+        Пустые записи (wN_arc == 0) отбрасываются. С event_time записи возвращаются парами (время, запись):
+        запись narc относится к event_time, следующие - с шагом step
+        """
+        async for next_narc, page in self._read_pages(type_metrics, narc, count, page_size):
+            yield next_narc, self._unpack_archive([page], as_array, event_time, step)
+
+            if event_time is not None:
+                event_time += len(page) // ARCH_CODEC.size * step
 
-        if self.compute_crc(raw[:-2]) != raw[-2:]:
-            raise Crc16Exception('_parse_metrics: Checksum is incorrect')
+    async def _read_pages(self, type_metrics, narc, count, page_size=None):
+        arch_size = self.arch_size(type_metrics)
 
-        return self.funcs_and_commands_table[func][0](raw[3:-2], args)
+        while count > 0:
+            # Без заданного размера страница подбирается по текущему качеству связи.
+            # Страница не переходит через конец кольцевого буфера
+            size = min(page_size or self.link.page_size(), count, arch_size - narc)
+            page = await self.read_raw(3, narc & 255, narc >> 8, size, type_metrics=type_metrics)
+
+            if len(page) != ARCH_CODEC.size * size:
+                raise ResponseParseException('_read_pages: Incorrect archive length')
+
+            narc = (narc + size) % arch_size
+            count -= size
+
+            yield narc, page
+
+    def _unpack_archive(self, pages, as_array=NUMPY_ARCHIVES, event_time=None, step=None):
+        if as_array:
+            return self._unpack_archive_array(pages, event_time, step)
+
+        keys = self.int_archive_keys
+        records = (record for page in pages for record in ARCH_CODEC.iter_dicts(page))
+
+        if event_time is None:
+            return [{key: record[key] for key in keys} for record in records if record[WN_ARC] != 0]
+
+        # Время определяется позицией записи, поэтому считается до отбрасывания пустых
+        return [
+            (event_time + idx * step, {key: record[key] for key in keys})
+            for idx, record in enumerate(records) if record[WN_ARC] != 0
+        ]
+
+    def _unpack_archive_array(self, pages, event_time=None, step=None):
+        if not pages:
+            return []
+
+        records = np.concatenate([ARCH_CODEC.to_array(page) for page in pages])
+        positions = np.flatnonzero(records[WN_ARC] != 0)
+
+        # Словари создаются только на границе передачи данных
+        values = [
+            dict(zip(self.int_archive_keys, item)) for item in records[positions][self.int_archive_keys].tolist()
+        ]
+
+        if event_time is None:
+            return values
+
+        return [(event_time + idx * step, item) for idx, item in zip(positions.tolist(), values)]
 
     @staticmethod
     def _parse_settings(raw, args):
         response = {}
 
-        for key, value in zip(COMMON_DATA_STRUCT[SETTINGS], struct.unpack('<3f15b', raw)):
+        for key, value in SETTINGS_CODEC.iter_items(raw):
             if key == SERNUM:
                 response[key] = str(round(value))
 
@@ -271,71 +911,36 @@ class Device(NetDevice, TeploconCommon):
 
     @staticmethod
     def _parse_stat_time(raw, args):
-        return {
-            key: value for key, value in zip(COMMON_DATA_STRUCT[STAT_TIME], struct.unpack('<7b1L2b', raw))
-        }
+        return dict(STAT_TIME_CODEC.iter_items(raw))
 
     @staticmethod
     def _parse_current(raw, args):
-        current_params = struct.unpack('<4L2b7f', raw)
-        integral_data, period_data = current_params[:6], current_params[6:]
-
-        result_period = {key: value for key, value in zip(COMMON_DATA_STRUCT[PERIOD_CURRENT], period_data)}
-        result_integral = {key: value for key, value in zip(COMMON_DATA_STRUCT[INTEGRAL_CURRENT], integral_data)}
+        current_params = CURRENT_CODEC.unpack(raw)
+        split = len(COMMON_DATA_STRUCT[INTEGRAL_CURRENT])
+        integral_data, period_data = current_params[:split], current_params[split:]
 
         return [
-            result_period,
-            result_integral
+            dict(zip(COMMON_DATA_STRUCT[PERIOD_CURRENT], period_data)),
+            dict(zip(COMMON_DATA_STRUCT[INTEGRAL_CURRENT], integral_data)),
         ]
 
     @staticmethod
     def _parse_additional(raw, args):
-        additional_param = struct.unpack('<4L2f2H1f1b1H18b', raw)
-        integral_data, period_data = additional_param[:16], additional_param[16:]
-
-        result_period = {key: value for key, value in zip(COMMON_DATA_STRUCT[PERIOD_ADDITIONAL], period_data)}
-        result_integral = {key: value for key, value in zip(COMMON_DATA_STRUCT[INTEGRAL_ADDITIONAL], integral_data)}
+        additional_param = ADDITIONAL_CODEC.unpack(raw)
+        split = len(COMMON_DATA_STRUCT[INTEGRAL_ADDITIONAL])
+        integral_data, period_data = additional_param[:split], additional_param[split:]
 
         return [
-            result_period,
-            result_integral
+            dict(zip(COMMON_DATA_STRUCT[PERIOD_ADDITIONAL], period_data)),
+            dict(zip(COMMON_DATA_STRUCT[INTEGRAL_ADDITIONAL], integral_data)),
         ]
 
     @staticmethod
-    def _parse_month(raw, args):
-        arch_month = struct.unpack(f'<{STRUCT_ARCH * args[3]}', raw)
-        data_pack = COMMON_DATA_STRUCT[INTEGRAL_MONTH]
-        len_pack = len(data_pack)
-        responses_list = []
-
-        for i in range(0, len(arch_month), len_pack):
-            responses_list.append({key: value for key, value in zip(data_pack, arch_month[i: i + len_pack])})
-
-        return responses_list
-
-    @staticmethod
-    def _parse_day(raw, args):
-        arch_day = struct.unpack(f'<{STRUCT_ARCH * args[3]}', raw)
-        data_pack = COMMON_DATA_STRUCT[INTEGRAL_DAY]
-        len_pack = len(data_pack)
-        responses_list = []
-
-        for i in range(0, len(arch_day), len_pack):
-            responses_list.append({key: value for key, value in zip(data_pack, arch_day[i: i + len_pack])})
+    def _parse_archive(raw, args):
+        if len(raw) != ARCH_CODEC.size * args[3]:
+            raise ResponseParseException('_parse_archive: Incorrect archive length')
 
-        return responses_list
-
-    @staticmethod
-    def _parse_hour(raw, args):
-        arch_hour = struct.unpack(f'<{STRUCT_ARCH * args[3]}', raw)
-        data_pack = COMMON_DATA_STRUCT[INTEGRAL_HOUR]
-        len_pack = len(data_pack)
-        responses_list = []
-
-        for i in range(0, len(arch_hour), len_pack):
-            responses_list.append({key: value for key, value in zip(data_pack, arch_hour[i: i + len_pack])})
-
-        return responses_list
+        return ARCH_CODEC.iter_dicts(raw)
 
     @check_lock
     @connect
@@ -376,7 +981,7 @@ class Device(NetDevice, TeploconCommon):
 
     @check_lock
     @connect
-    @submit_response
+    @submit_response(is_sorted=True)
     @check_response
     @wrap_response
     async def process_integral_month(self, last_date):
@@ -384,69 +989,179 @@ class Device(NetDevice, TeploconCommon):
         Запрос интегральных показаний за месяц
         """
 
-        narc = self.get_narc(last_date)
-        num_page = self.eval_num_page(narc)
+        head = await self.locate_archive_head('month')
 
-        total_reponse = []
+        if head is None:
+            return
 
-        for i in range(num_page // 10):
-            int_months = await self.read_metrics(3, narc & 255, narc >> 8, 10, type_metrics='read_arch_month')
-            narc += 10
+        cursor = await self.get_cursor(INTEGRAL_MONTH)
+        narc = since = None
 
-            for int_month in int_months:
-                tmp_response = {'metric_type': INTEGRAL_MONTH, 'event_time': now(), 'metrics': {}}
-                tmp_response['metrics']['1'] = {key: int_month.get(key) for key in self.int_archive_keys}
+        # Продолжаем с позиции, сохраненной после последней переданной страницы
+        if cursor and (last_date is None or cursor['updated'] >= last_date):
+            narc, since = cursor['narc'], cursor['updated']
+        elif last_date is not None:
+            narc, since = self.get_narc(last_date), last_date
 
-                if tmp_response['metrics']['1']['wN_arc'] != 0:
-                    total_reponse.append(tmp_response)
+        if narc is None:
+            # Весь буфер в порядке записи: от следующей за последней записанной (самой старой
+            # после перехода через конец буфера) до последней. Пустые записи отбрасываются при разборе
+            narc, count = (head + 1) % NUM_MONT_MAX, NUM_MONT_MAX
+        else:
+            # Записи от narc до последней записанной включительно, с переходом через конец буфера
+            count = (head + 1 - narc) % NUM_MONT_MAX
 
-        remainder = num_page % 10
+            # narc за последней записанной (месяц еще не записан, расхождение часов) по модулю дал бы
+            # почти весь буфер: записей не может быть больше, чем месяцев прошло по часам прибора
+            scheme = await self.get_scheme()
 
-        if remainder:
-            int_months = await self.read_metrics(3, narc & 255, narc >> 8, remainder, type_metrics='read_arch_month')
+            if count > self.months_between(since, scheme['current_time']) + 1:
+                self.log.warning(
+                    f'{self.dev_id}: запись {narc} месячного архива не записана (последняя {head}), чтение отложено'
+                )
+                return
 
-            for int_month in int_months:
-                tmp_response = {'metric_type': INTEGRAL_MONTH, 'event_time': now(), 'metrics': {}}
-                tmp_response['metrics']['1'] = {key: int_month.get(key) for key in self.int_archive_keys}
+        # Каждая страница архива передается сразу после чтения
+        async for narc, int_months in self.iter_archive('read_arch_month', narc, count):
+            yield [
+                {'metric_type': INTEGRAL_MONTH, 'event_time': now(), 'metrics': {'1': int_month}}
+                for int_month in int_months
+            ]
 
-                if tmp_response['metrics']['1']['wN_arc'] != 0:
-                    total_reponse.append(tmp_response)
+            # Курсор сдвигается только после подтвержденной передачи страницы,
+            # при ошибке чтение продолжится с этой страницы при следующем опросе
+            if not await self.confirm_submitted():
+                return
 
-        return total_reponse
+            await self.set_cursor(INTEGRAL_MONTH, narc=narc)
 
     @check_lock
     @connect
-    @submit_response
+    @submit_response(is_sorted=True)
     @check_response
     @wrap_response
     async def process_integral_day(self, last_date):
         """
         Запрос интегральных показаний за сутки
         """
-        int_days = await self.read_metrics(3, 0, 1, 2, type_metrics='read_arch_day')
-        response = {'metric_type': INTEGRAL_DAY, 'event_time': now(), 'metrics': {}}
-
-        for i, int_day in enumerate(int_days):
-            response['metrics'][str(i + 1)] = {key: int_day.get(key) for key in self.int_archive_keys}
-
-        return [response]
+        async for data in self.iter_archive_range(INTEGRAL_DAY, 'day', last_date, default_count=2):
+            yield data
 
     @check_lock
     @connect
-    @submit_response
+    @submit_response(is_sorted=True)
     @check_response
     @wrap_response
     async def process_integral_hour(self, last_date):
         """
         Запрос интегральных показаний за час
         """
-        int_hours = await self.read_metrics(3, 0, 1, 3, type_metrics='read_arch_hour')
-        response = {'metric_type': INTEGRAL_HOUR, 'event_time': now(), 'metrics': {}}
+        async for data in self.iter_archive_range(INTEGRAL_HOUR, 'hour', last_date, default_count=3):
+            yield data
+
+    async def iter_archive_range(self, metric_type, archive, last_date, default_count):
+        """
+        Чтение записей архива, появившихся после last_date, страницами по текущему качеству связи.
+        Последняя записанная запись относится к периоду, закончившемуся по часам прибора,
+        время остальных отсчитывается от нее с шагом архива. После каждой переданной страницы
+        сохраняется курсор, следующий опрос продолжает чтение с него
+        """
+        head = await self.locate_archive_head(archive)
 
-        for i, int_hour in enumerate(int_hours):
-            response['metrics'][str(i + 1)] = {key: int_hour.get(key) for key in self.int_archive_keys}
+        if head is None:
+            return
 
-        return [response]
+        arch_size = ARCH_SIZES[archive]
+        step = delta(metric_type)
+
+        scheme = await self.get_scheme()
+        head_time = self.resolve_head_time((self.dev_id, archive), head, scheme['current_time'], archive, step)
+
+        if head_time is None:
+            # Время записей не определено однозначно - они будут прочитаны при следующем опросе
+            self.log.warning(f'{self.dev_id}: время последней записи архива {archive} не определено, чтение отложено')
+            return
+
+        cursor = await self.get_cursor(metric_type)
+        narc, count = self.archive_range(head, head_time, arch_size, step, cursor, last_date, default_count)
+
+        # Время записи по ее номеру: последняя записанная относится к head_time
+        def slot_time(slot):
+            return head_time - ((head - slot) % arch_size) * step
+
+        records_iter = self.iter_archive(f'read_arch_{archive}', narc, count, event_time=slot_time(narc), step=step)
+
+        async for narc, records in records_iter:
+            yield [
+                {'metric_type': metric_type, 'event_time': record_time, 'metrics': {'1': record}}
+                for record_time, record in records
+            ]
+
+            # Как и для месячного архива, курсор сдвигается только после подтвержденной передачи страницы
+            if not await self.confirm_submitted():
+                return
+
+            await self.set_cursor(metric_type, narc=narc, event_time=slot_time(narc - 1))
+
+    @staticmethod
+    def archive_range(head, head_time, arch_size, step, cursor, last_date, default_count):
+        """
+        Записи к чтению до последней записанной head включительно: (номер первой, число).
+        С курсора чтение продолжается по номерам записей, поэтому пропущенный прибором период не сдвигает
+        уже переданные записи. Без курсора, если он старше last_date или буфер после него перезаписан,
+        число записей считается по времени от last_date
+        """
+        if cursor and (last_date is None or cursor['event_time'] >= last_date) and \
+                head_time - cursor['event_time'] < step * arch_size:
+            count = (head + 1 - cursor['narc']) % arch_size
+
+            # Курсор за последней записанной (архив прибора очищен, часы сдвинулись назад) по модулю дал бы
+            # почти весь буфер: новых записей не больше, чем периодов прошло после курсора
+            count = min(count, max(0, (head_time - cursor['event_time']) // step))
+        elif last_date is not None:
+            count = max(0, min((head_time - last_date) // step, arch_size))
+        else:
+            count = min(default_count, arch_size)
+
+        return (head + 1 - count) % arch_size, count
+
+    @classmethod
+    def resolve_head_time(cls, key, head, current_time, archive, step):
+        """
+        Время периода последней записанной записи. По часам прибора это последний закончившийся период,
+        но сразу после его окончания запись может быть еще не сделана. Поэтому время сверяется с привязкой
+        (номер записи, время), полученной в предыдущих опросах. None - время не определено однозначно
+        """
+        arch_size = ARCH_SIZES[archive]
+        head_time = cls.period_end(current_time, archive)
+
+        expected = None
+        anchor = cls._archive_anchors.get(key)
+
+        # Привязка старше кольцевого буфера не позволяет определить число записей после нее
+        if anchor is not None and head_time - anchor[1] < step * arch_size:
+            expected = anchor[1] + ((head - anchor[0]) % arch_size) * step
+
+        if (current_time - head_time).total_seconds() < ARCH_WRITE_DELAY:
+            # Последней может быть запись за закончившийся или за предыдущий период
+            return expected if expected in (head_time, head_time - step) else None
+
+        cls._archive_anchors[key] = (head, head_time)
+
+        if expected is not None and expected != head_time:
+            # Прибор не записал период или часы сдвинулись: новая привязка по часам используется,
+            # только если следующий опрос ее подтвердит. Уже переданные записи не перечитываются -
+            # чтение продолжается по номеру записи из курсора
+            return None
+
+        return head_time
+
+    @staticmethod
+    def period_end(current_time, archive):
+        if archive == 'day':
+            return current_time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        return current_time.replace(minute=0, second=0, microsecond=0)
 
 def main():
     # Inital
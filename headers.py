@@ -179,12 +179,48 @@ NUM_HOUR_MAX = 1008     # Число записей почасового арх
 NUM_DAY_MAX = 300       # Число записей поуточного архива
 NUM_MONT_MAX = 50       # Число записей помесячного архива
 STRUCT_ARCH = '2b3H2b3L1H'  # Структура архивной записи
+STRUCT_SETTINGS = '3f15b'   # Структура настроек прибора
+STRUCT_STAT_TIME = '7b1L2b'     # Структура статуса и времени работы
+STRUCT_CURRENT = '4L2b7f'       # Структура текущих параметров
+STRUCT_ADDITIONAL = '4L2f2H1f1b1H18b'   # Структура дополнительных параметров
 BUFFER_SIZE = 1024    
+FRAME_HEADER_LEN = 3    # Длина заголовка ответа
+FRAME_CRC_LEN = 2       # Длина контрольной суммы
+ARCH_PAGE_SIZE = 10     # Число архивных записей в одном запросе
+ARCH_MAX_PAGE_SIZE = (BUFFER_SIZE - FRAME_HEADER_LEN - FRAME_CRC_LEN) // ARCH_LEN  # Записей в одном кадре ответа
+
+# Размеры кольцевых буферов архивов
+ARCH_SIZES = {
+    'month': NUM_MONT_MAX,
+    'day': NUM_DAY_MAX,
+    'hour': NUM_HOUR_MAX,
+}
+
+# Контрольная сумма CRC16/MODBUS
+CRC16_POLY = 0xA001
+CRC16_INIT = 0xFFFF
 
 # Паузы разделяющие пакеты и таймауты
 LONG_RESPONSE_TIMEOUT = 0.25
 DEFAULT_TIMEOUT = 0.20
 
+# Оценка качества связи: SRTT/RTTVAR по RFC 6298 и сглаженные скорость и доля сбоев CRC
+LINK_RTT_ALPHA = 1 / 8
+LINK_RTT_BETA = 1 / 4
+LINK_RTT_K = 4
+LINK_RTT_GRANULARITY = 0.01
+LINK_RTO_MIN = DEFAULT_TIMEOUT
+LINK_RTO_MAX = 10.0
+LINK_EWMA = 1 / 8
+LINK_PAGE_TIME = 1.0        # Желаемое время передачи страницы архива, сек
+LINK_PAGE_ERRORS = 0.1      # Допустимое ожидаемое число сбоев CRC на страницу архива
+
+# Время записи архива прибором после окончания периода с запасом на уход часов, сек
+ARCH_WRITE_DELAY = 2 * 60
+
+# Время жизни кэша ответов в рамках сессии соединения, сек
+REQUEST_CACHE_TTL = 2.0
+
 # Скорость канала
 BOUDRATES = {
     600: 0x31,
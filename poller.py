@@ -0,0 +1,258 @@
+import asyncio
+import heapq
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from inquirer_utils.headers import CURRENT
+from is74_utils import now, logger
+
+from inquirer_plugins.utils import get_period_boundary, submit_queue
+
+POLL_CONCURRENCY = int(os.environ.get('POLL_CONCURRENCY', 500))
+GATEWAY_CONCURRENCY = int(os.environ.get('GATEWAY_CONCURRENCY', 1))
+POLL_INTERVAL = int(os.environ.get('POLL_INTERVAL', 60 * 60))
+# Задержка опроса после границы периода, пока прибор записывает архив
+POLL_DUE_DELAY = int(os.environ.get('POLL_DUE_DELAY', 5 * 60))
+# Повтор опроса метрик после ошибки
+POLL_RETRY_DELAY = int(os.environ.get('POLL_RETRY_DELAY', 5 * 60))
+
+
+class PollReport:
+    """
+    Итоги одного цикла опроса: время, результат и ошибка по каждому устройству
+    """
+
+    def __init__(self):
+        self.started = now()
+        self.finished = None
+        self.results = {}
+        self.submit_failures = []
+
+    def add(self, dev_id, duration, error=None):
+        self.results[dev_id] = {
+            'ok': error is None,
+            'duration': round(duration, 3),
+            'error': str(error) if error is not None else None,
+        }
+
+    @property
+    def failed(self):
+        return {dev_id: result['error'] for dev_id, result in self.results.items() if not result['ok']}
+
+    def summary(self):
+        durations = [result['duration'] for result in self.results.values()]
+
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'total': len(self.results),
+            'ok': len(self.results) - len(self.failed),
+            'failed': len(self.failed),
+            'submit_failed': len(self.submit_failures),
+            'max_duration': max(durations, default=0),
+            'sum_duration': round(sum(durations), 3),
+        }
+
+
+class DueScheduler:
+    """
+    Сроки следующего опроса по (dev_id, metric_type) на min-куче.
+    В цикл опроса попадают только устройства, у которых есть данные к сбору
+    """
+
+    def __init__(self, current_interval=POLL_INTERVAL, due_delay=POLL_DUE_DELAY):
+        self.current_interval = current_interval
+        self.due_delay = due_delay
+
+        self._heap = []
+        # (dev_id, metric_type) -> актуальный срок, записи кучи с другим сроком устарели
+        self._due = {}
+        self._devices = set()
+
+    def __len__(self):
+        return len(self._due)
+
+    def is_known(self, dev_id):
+        return dev_id in self._devices
+
+    def schedule(self, dev_id, metric_type, due_date):
+        self._devices.add(dev_id)
+        self._due[(dev_id, metric_type)] = due_date
+        heapq.heappush(self._heap, (due_date, str(dev_id), str(metric_type), dev_id, metric_type))
+
+    def next_due(self):
+        while self._heap:
+            due_date, *_, dev_id, metric_type = self._heap[0]
+
+            if self._due.get((dev_id, metric_type)) == due_date:
+                return due_date
+
+            heapq.heappop(self._heap)
+
+    def pop_due(self, moment=None):
+        """
+        Извлечение наступивших сроков, возвращает {dev_id: [metric_type, ...]}
+        """
+        moment = moment or now()
+        due = defaultdict(list)
+
+        while self._heap and self._heap[0][0] <= moment:
+            due_date, *_, dev_id, metric_type = heapq.heappop(self._heap)
+
+            if self._due.get((dev_id, metric_type)) != due_date:
+                continue
+
+            del self._due[(dev_id, metric_type)]
+            due[dev_id].append(metric_type)
+
+        return dict(due)
+
+    def get_due_date(self, metric_type, polled_at, report_day=31, last_date=None):
+        """
+        Срок опроса по границе периода после последней полученной записи.
+        Если новая запись к моменту опроса не появилась, ждем следующую границу после опроса
+        """
+        if CURRENT in metric_type:
+            return polled_at + timedelta(seconds=self.current_interval)
+
+        boundary = get_period_boundary(metric_type, last_date or polled_at, report_day)
+
+        if boundary <= polled_at:
+            boundary = get_period_boundary(metric_type, polled_at, report_day)
+
+        return boundary + timedelta(seconds=self.due_delay)
+
+    async def reschedule(self, device, polled_at, metric_types=None):
+        config = await device.get_config()
+
+        for metric_type, _ in config['data_availability']:
+            if metric_types is None or metric_type in metric_types:
+                due_date = self.get_due_date(
+                    metric_type, polled_at, device.report_day, device.last_event_times.get(metric_type)
+                )
+                self.schedule(device.dev_id, metric_type, due_date)
+
+
+class FleetPoller:
+    """
+    Опрос всех устройств модели с ограничением числа одновременных опросов:
+    общим и на каждый шлюз (ip, port)
+    """
+
+    def __init__(self, device_cls, func=None, proc=None,
+                 concurrency=POLL_CONCURRENCY, gateway_concurrency=GATEWAY_CONCURRENCY, scheduler=None):
+        self.device_cls = device_cls
+        self.func = func
+        self.proc = proc
+        self.scheduler = scheduler
+
+        self.concurrency = concurrency
+        self.gateway_concurrency = gateway_concurrency
+
+        self._semaphore = None
+        self._gateways = None
+
+    async def load_devices(self):
+        raw_devices = await self.device_cls.get_devices_query()
+        return await self.device_cls.parse_devices(raw_devices)
+
+    @staticmethod
+    def gateway_key(params):
+        if params.get('ip') is None:
+            return None
+
+        return params['ip'], params.get('port')
+
+    async def poll_device(self, params, report, metric_types=None):
+        params = dict(params)
+        last_dates = params.pop('last_dates', None)
+        dev_id = params.get('dev_id')
+
+        gateway = self._gateways[self.gateway_key(params)]
+
+        # Сначала ждем шлюз, чтобы ожидающие своей очереди устройства не занимали общий лимит
+        async with gateway, self._semaphore:
+            started = asyncio.get_event_loop().time()
+            error = None
+
+            try:
+                async with self.device_cls(**params, func=self.func, proc=self.proc) as device:
+                    # Обновления конфигураций записываются пачкой в конце цикла
+                    device.flush_config_on_exit = False
+                    polled_at = now()
+                    await device.process_metrics(last_dates=last_dates, metric_types=metric_types)
+
+                    if self.scheduler is not None:
+                        await self.scheduler.reschedule(device, polled_at, metric_types)
+            except Exception as e:
+                error = e
+                logger.error(f'{dev_id}: {e}')
+
+                # При ошибке метрики опрашиваются повторно через POLL_RETRY_DELAY
+                if self.scheduler is not None:
+                    for metric_type in metric_types or []:
+                        self.scheduler.schedule(dev_id, metric_type, now() + timedelta(seconds=POLL_RETRY_DELAY))
+
+            report.add(dev_id, asyncio.get_event_loop().time() - started, error)
+
+    async def run_cycle(self, devices=None):
+        if devices is None:
+            devices = await self.load_devices()
+
+        due = {}
+
+        if self.scheduler is not None:
+            due = self.scheduler.pop_due()
+            # Устройства без сроков в очереди опрашиваются полностью
+            devices = [params for params in devices
+                       if params['dev_id'] in due or not self.scheduler.is_known(params['dev_id'])]
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._gateways = defaultdict(lambda: asyncio.Semaphore(self.gateway_concurrency))
+        self._gateways[None] = asyncio.Semaphore(self.concurrency)
+
+        await self.device_cls.prefetch_configs([params['dev_id'] for params in devices])
+
+        report = PollReport()
+
+        try:
+            await asyncio.gather(*[
+                self.poll_device(params, report, due.get(params['dev_id'])) for params in devices
+            ])
+        finally:
+            await self.device_cls.flush_configs()
+            await submit_queue.join()
+
+        report.submit_failures = submit_queue.pop_failures()
+        report.finished = now()
+        logger.info(f'{self.device_cls.__name__}: {report.summary()}')
+
+        return report
+
+    def get_sleep_time(self, interval, elapsed):
+        """
+        Пауза до следующего цикла: до ближайшего срока опроса в планировщике,
+        но не дольше interval - за это время могут появиться новые устройства
+        """
+        sleep_time = interval - elapsed
+
+        if self.scheduler is not None:
+            due_date = self.scheduler.next_due()
+
+            if due_date is not None:
+                # Не меньше секунды, чтобы срок наступил и по часам с точностью до секунды
+                sleep_time = max(1, min(sleep_time, (due_date - now()).total_seconds()))
+
+        return max(0, sleep_time)
+
+    async def run_forever(self, interval=POLL_INTERVAL):
+        while True:
+            started = asyncio.get_event_loop().time()
+
+            try:
+                await self.run_cycle()
+            except Exception as e:
+                logger.error(f'{self.device_cls.__name__}: ошибка цикла опроса: {e}')
+
+            await asyncio.sleep(self.get_sleep_time(interval, asyncio.get_event_loop().time() - started))
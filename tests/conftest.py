@@ -0,0 +1,128 @@
+import asyncio
+import struct
+from datetime import datetime
+
+import pytest
+
+from inquirer_plugins import utils
+from inquirer_plugins.base import BaseDevice, ConfigCache, ConfigWriter
+from inquirer_plugins.devices.teplocon_01.device import Device, GatewaySession, crc16
+from inquirer_plugins.devices.teplocon_01.headers import (
+    ARCH_SIZES, CMD_READ_DAY_ARCH, CMD_READ_HOUR_ARCH, CMD_READ_MONTH_ARCH, CMD_READ_SETTINGS, STRUCT_ARCH,
+    STRUCT_SETTINGS
+)
+
+ARCH_COMMANDS = {
+    CMD_READ_MONTH_ARCH & 0xF0: 'month',
+    CMD_READ_DAY_ARCH & 0xF0: 'day',
+    CMD_READ_HOUR_ARCH & 0xF0: 'hour',
+}
+
+
+class FakeGateway:
+    """
+    Преобразователь интерфейсов с одним теплосчетчиком: часы прибора и кольцевые архивы.
+    Архив - словарь номер записи -> wN_arc, остальные поля записи выводятся из номера
+    """
+
+    def __init__(self, current_time=datetime(2020, 1, 1, 10, 30)):
+        self.current_time = current_time
+        self.archives = {archive: {} for archive in ARCH_SIZES}
+        self.requests = []
+
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        return self
+
+    def close(self):
+        self.server.close()
+
+    def write(self, archive, narc, wn):
+        self.archives[archive][narc % ARCH_SIZES[archive]] = wn
+
+    @staticmethod
+    def record(narc, wn):
+        return struct.pack(f'<{STRUCT_ARCH}', 0, 0, 60, 70, 40, 5, 3, 1000 + narc, 900 + narc, 50 + narc, wn)
+
+    def reply(self, request):
+        dev_num, cmd, *args = request[:-2]
+
+        if cmd == CMD_READ_SETTINGS:
+            moment = self.current_time
+            return struct.pack(
+                f'<{STRUCT_SETTINGS}', 2.21, 112121.0, 0.001, 25, 1, 0,
+                moment.minute, moment.hour, moment.day, moment.month, moment.year - 2000, *[0] * 7
+            )
+
+        archive = self.archives[ARCH_COMMANDS[cmd & 0xF0]]
+        narc, count = args[1] | (args[2] << 8), args[3]
+
+        return b''.join(self.record(idx, archive.get(idx, 0)) for idx in range(narc, narc + count))
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.read(64)
+
+                if not request:
+                    break
+
+                self.requests.append(request)
+                payload = self.reply(request)
+                frame = bytes(request[:2]) + bytes([len(payload) & 0xFF]) + payload
+
+                writer.write(frame + crc16(frame))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+def mdb(monkeypatch):
+    """
+    Конфигурации устройств в mongomock вместо Mongo, отдельные кэш и буфер записи на тест
+    """
+    mongomock_motor = pytest.importorskip('mongomock_motor')
+    mdb = mongomock_motor.AsyncMongoMockClient()['partner']
+
+    monkeypatch.setattr(BaseDevice, '_BaseDevice__mdb', mdb)
+    monkeypatch.setattr(BaseDevice, '_BaseDevice__config_cache', ConfigCache(max_size=10, ttl=60))
+    monkeypatch.setattr(BaseDevice, '_BaseDevice__config_writer', ConfigWriter(mdb['configs'], interval=60))
+
+    return mdb
+
+
+@pytest.fixture
+def teplocon(mdb, monkeypatch):
+    """
+    Фабрика опроса прибора за FakeGateway: teplocon(gateway) возвращает открытый Device,
+    переданные записи накапливаются в device.submitted
+    """
+    monkeypatch.setattr(utils, 'DONT_SUBMIT', False)
+    monkeypatch.setattr(Device, '_archive_heads', {})
+    monkeypatch.setattr(Device, '_archive_anchors', {})
+    monkeypatch.setattr(GatewaySession, '_sessions', {})
+
+    async def open_device(gateway):
+        device = Device(dev_id='1', ip='127.0.0.1', port=gateway.port, dev_num=1)
+        device.submitted = []
+
+        async def submit(service, method, dev_id, data):
+            device.submitted += data['data']
+
+        device.func = submit
+        # Блокировка в Redis не нужна: вызовы идут как вложенные под уже захваченной
+        device.lock_depth = 1
+
+        await device.open()
+
+        return device
+
+    return open_device
@@ -0,0 +1,167 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import FakeGateway
+from inquirer_plugins.devices.teplocon_01.device import Device
+from inquirer_plugins.devices.teplocon_01.headers import CMD_READ_HOUR_ARCH
+
+
+@pytest.mark.parametrize('last_date, expected', [
+    # Месяц last_date еще не записан: narc сразу за последней записанной
+    (datetime(2020, 1, 1), []),
+    # narc дальше последней записанной: часы сервера и прибора расходятся
+    (datetime(2020, 2, 1), []),
+    (datetime(2019, 10, 1), [37, 38, 39]),
+])
+def test_month_range_stops_at_head(teplocon, last_date, expected):
+    async def run():
+        gateway = await FakeGateway(current_time=datetime(2020, 1, 10, 12)).start()
+
+        # Записи по декабрь 2019 (номер записи 39)
+        for narc in range(40):
+            gateway.write('month', narc, narc + 1)
+
+        device = await teplocon(gateway)
+
+        try:
+            await device.process_integral_month(last_date=last_date)
+        finally:
+            await device.close_async()
+            gateway.close()
+
+        return [record['metrics']['1']['wN_arc'] - 1 for record in device.submitted]
+
+    assert asyncio.run(run()) == expected
+
+
+@pytest.mark.parametrize('as_array', [False, True])
+def test_unpack_archive_keeps_slot_times(as_array):
+    if as_array:
+        pytest.importorskip('numpy')
+
+    async def make_device():
+        return Device(dev_id='1', ip='127.0.0.1', port=0, dev_num=1)
+
+    device = asyncio.run(make_device())
+    started, step = datetime(2020, 1, 1), timedelta(hours=1)
+    pages = [
+        b''.join(FakeGateway.record(narc, wn) for narc, wn in enumerate((1, 0, 3), start)) for start in (0, 3)
+    ]
+
+    records = device._unpack_archive(pages, as_array, started, step)
+
+    # Пустые записи отбрасываются, время остальных определяется их позицией
+    assert [(record_time, record['wN_arc']) for record_time, record in records] == [
+        (started, 1), (started + 2 * step, 3), (started + 3 * step, 1), (started + 5 * step, 3)
+    ]
+    assert records == device._unpack_archive(pages, not as_array, started, step)
+    assert [record for _, record in records] == device._unpack_archive(pages, as_array)
+
+
+HOUR = timedelta(hours=1)
+
+
+async def poll_hours(teplocon, gateway, last_date, fail_on=None):
+    """
+    Опрос часового архива новым экземпляром устройства, как в цикле опроса.
+    fail_on - номер вызова передачи, на котором DeviceSubmitter недоступен
+    """
+    device = await teplocon(gateway)
+    submit, calls = device.func, []
+
+    async def flaky_submit(service, method, dev_id, data):
+        calls.append(data)
+
+        if len(calls) == fail_on:
+            raise ConnectionError('DeviceSubmitter is down')
+
+        await submit(service, method, dev_id, data)
+
+    device.func = flaky_submit
+
+    try:
+        await device.process_integral_hour(last_date=last_date)
+    except ConnectionError:
+        pass
+    finally:
+        await device.close_async()
+
+    return [(record['event_time'], record['metrics']['1']['wN_arc']) for record in device.submitted]
+
+
+def test_hour_backfill_resumes_from_cursor(teplocon):
+    async def run():
+        gateway = await FakeGateway(current_time=datetime(2020, 1, 3, 10, 30)).start()
+
+        # 59 часовых записей, последняя - за 9:00-10:00 3 января
+        for narc in range(59):
+            gateway.write('hour', narc, narc + 1)
+
+        started = datetime(2020, 1, 3, 10) - 58 * HOUR
+
+        try:
+            # Вторая страница не передана: курсор остается после первой
+            first = await poll_hours(teplocon, gateway, last_date=started - HOUR, fail_on=2)
+            assert first and len(first) < 59
+
+            # Следующий опрос продолжает с курсора без повторной передачи первой страницы
+            second = await poll_hours(teplocon, gateway, last_date=first[-1][0])
+            assert first + second == [(started + idx * HOUR, idx + 1) for idx in range(59)]
+
+            # Новых записей нет - ничего не читается
+            gateway.requests.clear()
+            assert await poll_hours(teplocon, gateway, last_date=second[-1][0]) == []
+            assert not [request for request in gateway.requests if request[1] == CMD_READ_HOUR_ARCH]
+        finally:
+            gateway.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('cursor, last_date, expected', [
+    # Продолжение с курсора
+    ({'narc': 8, 'event_time': datetime(2020, 1, 1, 7)}, datetime(2020, 1, 1, 7), (8, 3)),
+    # Все записи переданы
+    ({'narc': 11, 'event_time': datetime(2020, 1, 1, 10)}, datetime(2020, 1, 1, 10), (11, 0)),
+    # Курсор за последней записанной не превращается в весь буфер
+    ({'narc': 13, 'event_time': datetime(2020, 1, 1, 10)}, None, (11, 0)),
+    # Курсор старше last_date - по времени
+    ({'narc': 2, 'event_time': datetime(2020, 1, 1, 1)}, datetime(2020, 1, 1, 8), (9, 2)),
+    # Буфер перезаписан после курсора
+    ({'narc': 2, 'event_time': datetime(2019, 11, 1)}, None, (8, 3)),
+    (None, datetime(2019, 1, 1), (11, 1008)),
+    (None, None, (8, 3)),
+])
+def test_archive_range(cursor, last_date, expected):
+    assert Device.archive_range(10, datetime(2020, 1, 1, 10), 1008, HOUR, cursor, last_date, 3) == expected
+
+
+def test_missed_period_does_not_resubmit(teplocon):
+    async def run():
+        gateway = await FakeGateway(current_time=datetime(2020, 1, 1, 10, 30)).start()
+
+        for narc in range(11):
+            gateway.write('hour', narc, narc + 1)
+
+        try:
+            assert await poll_hours(teplocon, gateway, last_date=datetime(2020, 1, 1, 9)) == [
+                (datetime(2020, 1, 1, 10), 11)
+            ]
+
+            # Запись за 10:00-11:00 пропущена прибором, в 12:00 записан период 11:00-12:00
+            gateway.write('hour', 11, 12)
+
+            gateway.current_time = datetime(2020, 1, 1, 12, 30)
+            assert await poll_hours(teplocon, gateway, last_date=datetime(2020, 1, 1, 10)) == []
+
+            # Запись 10 не передается повторно под временем 11:00
+            gateway.current_time = datetime(2020, 1, 1, 12, 40)
+            assert await poll_hours(teplocon, gateway, last_date=datetime(2020, 1, 1, 10)) == [
+                (datetime(2020, 1, 1, 12), 12)
+            ]
+        finally:
+            gateway.close()
+
+    asyncio.run(run())
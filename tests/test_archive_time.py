@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from inquirer_plugins.devices.teplocon_01.device import Device
+
+HOUR = timedelta(hours=1)
+KEY = ('1', 'hour')
+
+
+@pytest.fixture(autouse=True)
+def anchors(monkeypatch):
+    monkeypatch.setattr(Device, '_archive_anchors', {})
+
+
+def resolve(head, current_time):
+    return Device.resolve_head_time(KEY, head, current_time, 'hour', HOUR)
+
+
+def test_clock_sets_anchor_outside_write_window():
+    assert resolve(10, datetime(2020, 1, 1, 10, 30)) == datetime(2020, 1, 1, 10)
+    assert Device._archive_anchors[KEY] == (10, datetime(2020, 1, 1, 10))
+
+
+def test_write_window_without_anchor_is_skipped():
+    assert resolve(10, datetime(2020, 1, 1, 11, 1)) is None
+
+
+@pytest.mark.parametrize('head, head_time', [
+    # Запись за 10:00-11:00 еще не сделана
+    (10, datetime(2020, 1, 1, 10)),
+    # Запись уже сделана
+    (11, datetime(2020, 1, 1, 11)),
+])
+def test_write_window_uses_anchor(head, head_time):
+    resolve(10, datetime(2020, 1, 1, 10, 30))
+
+    assert resolve(head, datetime(2020, 1, 1, 11, 1)) == head_time
+
+
+def test_missing_record_is_flagged():
+    resolve(10, datetime(2020, 1, 1, 10, 30))
+
+    # Через два часа голова сдвинулась на одну запись: время по часам не подтверждается
+    assert resolve(11, datetime(2020, 1, 1, 12, 30)) is None
+    assert Device._archive_anchors[KEY] == (11, datetime(2020, 1, 1, 12))
+
+    # Следующий опрос подтверждает новую привязку
+    assert resolve(11, datetime(2020, 1, 1, 12, 40)) == datetime(2020, 1, 1, 12)
+
+
+def test_anchor_across_ring_end():
+    resolve(1007, datetime(2020, 1, 1, 10, 30))
+
+    assert resolve(2, datetime(2020, 1, 1, 13, 30)) == datetime(2020, 1, 1, 13)
@@ -0,0 +1,22 @@
+import pytest
+
+from inquirer_plugins.devices.teplocon_01.device import ADDITIONAL_CODEC, CURRENT_CODEC, Device
+from inquirer_plugins.devices.teplocon_01.headers import (
+    COMMON_DATA_STRUCT, INTEGRAL_ADDITIONAL, INTEGRAL_CURRENT, PERIOD_ADDITIONAL, PERIOD_CURRENT
+)
+
+
+@pytest.mark.parametrize('codec, parse, integral, period', [
+    (CURRENT_CODEC, Device._parse_current, INTEGRAL_CURRENT, PERIOD_CURRENT),
+    (ADDITIONAL_CODEC, Device._parse_additional, INTEGRAL_ADDITIONAL, PERIOD_ADDITIONAL),
+])
+def test_parse_splits_by_structure(codec, parse, integral, period):
+    values = tuple(range(1, len(codec.struct.unpack(bytes(codec.size))) + 1))
+    period_data, integral_data = parse(codec.struct.pack(*values), (0,))
+
+    # Поля идут в ответе подряд: сначала интегральные, затем периодические
+    expected = dict(codec.iter_items(codec.struct.pack(*values)))
+
+    assert list(integral_data) == COMMON_DATA_STRUCT[integral]
+    assert list(period_data) == COMMON_DATA_STRUCT[period]
+    assert {**integral_data, **period_data} == expected
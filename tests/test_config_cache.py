@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from inquirer_plugins import base
+from inquirer_plugins.base import BaseDevice, ConfigCache
+
+pytest.importorskip('mongomock_motor')
+
+
+class Clock:
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(base.time, 'monotonic', clock)
+
+    return clock
+
+
+def config_cache():
+    return BaseDevice._BaseDevice__config_cache
+
+
+def test_cache_ttl_and_lru(clock):
+    cache = ConfigCache(max_size=2, ttl=60)
+
+    cache.set('1', {'a': 1})
+    cache.set('2', {'a': 2})
+    assert cache.get('1') == {'a': 1}
+
+    # '2' давно не использовался и вытесняется первым
+    cache.set('3', {'a': 3})
+    assert cache.get('2') is None
+    assert cache.get('1') == {'a': 1}
+
+    clock.time += 61
+    assert cache.get('1') is None
+    assert len(cache) == 1
+
+
+def test_cache_returns_copies(clock):
+    cache = ConfigCache()
+    cache.set('1', {'cursors': {}})
+
+    cache.get('1')['cursors']['integral_month'] = {'narc': 5}
+
+    assert cache.get('1') == {'cursors': {}}
+
+
+def test_mdb_config_hit_miss_and_invalidate(mdb, clock):
+    async def run():
+        await mdb['configs'].insert_one({'dev_id': '1', 'report_day': 25})
+        device = BaseDevice('1')
+
+        assert (await device.mdb_config)['report_day'] == 25
+
+        # Повторное чтение из кэша не видит изменений в Mongo до устаревания или сброса записи
+        await mdb['configs'].update_one({'dev_id': '1'}, {'$set': {'report_day': 20}})
+        assert (await device.mdb_config)['report_day'] == 25
+
+        config_cache().invalidate('1')
+        assert (await device.mdb_config)['report_day'] == 20
+
+        await mdb['configs'].update_one({'dev_id': '1'}, {'$set': {'report_day': 15}})
+        clock.time += 61
+        assert (await device.mdb_config)['report_day'] == 15
+
+    asyncio.run(run())
+
+
+def test_prefetch_configs(mdb, clock):
+    async def run():
+        await mdb['configs'].insert_many([{'dev_id': '1', 'report_day': 25}, {'dev_id': '2', 'report_day': 20}])
+        await BaseDevice.prefetch_configs([1, 2, 3])
+
+        # После загрузки пачкой конфигурации берутся из кэша, в том числе пустая для устройства без записи
+        await mdb['configs'].delete_many({})
+
+        assert (await BaseDevice('1').mdb_config)['report_day'] == 25
+        assert (await BaseDevice('2').mdb_config)['report_day'] == 20
+        assert await BaseDevice('3').mdb_config == {}
+
+    asyncio.run(run())
+
+
+def test_set_mdb_config_updates_cache_and_overlay(mdb, clock):
+    async def run():
+        await mdb['configs'].insert_one({'dev_id': '1', 'report_day': 25})
+        device = BaseDevice('1')
+        await device.mdb_config
+
+        await device.set_cursor('integral_month', narc=5)
+
+        # До записи в Mongo обновление видно через кэш и буфер записи
+        assert (await device.mdb_config)['cursors']['integral_month']['narc'] == 5
+        assert config_cache().get('1')['cursors']['integral_month']['narc'] == 5
+        assert 'cursors' not in await mdb['configs'].find_one({'dev_id': '1'})
+
+        # Буфер записи виден и после сброса кэша
+        config_cache().invalidate()
+        assert (await device.mdb_config)['cursors']['integral_month']['narc'] == 5
+
+        assert await BaseDevice.flush_configs() == {}
+
+        stored = await mdb['configs'].find_one({'dev_id': '1'})
+        assert (stored['report_day'], stored['cursors']['integral_month']['narc']) == (25, 5)
+
+    asyncio.run(run())
+
+
+def test_device_exit_flushes_own_config(mdb, clock, monkeypatch):
+    class RedisPools:
+        async def get(self):
+            return None
+
+    monkeypatch.setattr(base, 'redis_pools', RedisPools())
+
+    async def run():
+        other = BaseDevice('2')
+        await other.set_mdb_config({'report_day': 20})
+
+        async with BaseDevice('1') as device:
+            await device.set_mdb_config({'report_day': 25})
+
+        assert (await mdb['configs'].find_one({'dev_id': '1'}))['report_day'] == 25
+        # Обновления других устройств остаются в буфере до общей записи
+        assert await mdb['configs'].find_one({'dev_id': '2'}) is None
+
+        await BaseDevice.flush_configs()
+
+    asyncio.run(run())
@@ -0,0 +1,120 @@
+import asyncio
+
+from inquirer_plugins.base import ConfigWriter, apply_config_update, merge_config_update
+
+
+class Collection:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.requests = []
+
+    async def bulk_write(self, requests, ordered=True):
+        if self.fail:
+            raise ConnectionError('Mongo is down')
+
+        self.requests += requests
+
+
+def flushed_set(collection):
+    return [request._doc['$set'] for request in collection.requests]
+
+
+def test_child_key_merges_into_pending_parent():
+    pending = merge_config_update({}, {'cursors': {}})
+    merge_config_update(pending, {'cursors.integral_month': {'narc': 5}})
+
+    assert pending == {'cursors': {'integral_month': {'narc': 5}}}
+
+
+def test_parent_key_drops_pending_children():
+    pending = merge_config_update({}, {'cursors.integral_month': {'narc': 5}, 'cursors_old': 1})
+    merge_config_update(pending, {'cursors': {}})
+
+    assert pending == {'cursors_old': 1, 'cursors': {}}
+
+
+def test_merged_update_matches_sequential_updates():
+    updates = [
+        {'a.b': 1, 'c': 2},
+        {'a': {'x': 1}},
+        {'a.y.z': 3, 'c': 4},
+        {'d.e': 5},
+    ]
+    pending, config = {}, {}
+
+    for update in updates:
+        merge_config_update(pending, update)
+        apply_config_update(config, update)
+
+    assert apply_config_update({}, pending) == config
+    assert not any(key.startswith(f'{other}.') for key in pending for other in pending)
+
+
+def test_flush_writes_conflict_free_set():
+    async def run():
+        collection = Collection()
+        writer = ConfigWriter(collection)
+
+        await writer.write('1', {'cursors': {}})
+        await writer.write('1', {'cursors.integral_month': {'narc': 5}})
+
+        assert await writer.close() == {}
+        assert flushed_set(collection) == [{'cursors': {'integral_month': {'narc': 5}}}]
+
+    asyncio.run(run())
+
+
+def test_failed_flush_keeps_newer_updates():
+    async def run():
+        collection = Collection(fail=True)
+        writer = ConfigWriter(collection)
+
+        await writer.write('1', {'cursors.integral_month': {'narc': 5}})
+        assert '1' in await writer.flush()
+
+        await writer.write('1', {'cursors': {}})
+        collection.fail = False
+        await writer.write('1', {'cursors.integral_day': {'narc': 1}})
+
+        await writer.close()
+        assert flushed_set(collection) == [{'cursors': {'integral_day': {'narc': 1}}}]
+
+    asyncio.run(run())
+
+
+def test_failed_timer_flush_is_retried():
+    async def run():
+        collection = Collection(fail=True)
+        writer = ConfigWriter(collection, interval=0.01)
+
+        await writer.write('1', {'cursors.integral_month': {'narc': 5}})
+        await asyncio.sleep(0.015)
+
+        # Запись по таймеру не удалась, обновление ждет следующего таймера, а не следующей записи
+        assert len(writer) == 1
+        collection.fail = False
+        await asyncio.sleep(0.03)
+
+        assert len(writer) == 0
+        assert flushed_set(collection) == [{'cursors.integral_month': {'narc': 5}}]
+
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_flush_selected_devices():
+    async def run():
+        collection = Collection()
+        writer = ConfigWriter(collection)
+
+        await writer.write('1', {'report_day': 25})
+        await writer.write('2', {'report_day': 20})
+
+        assert await writer.flush(['1', '3']) == {}
+        assert flushed_set(collection) == [{'report_day': 25}]
+        assert writer.pending('2') == {'report_day': 20}
+
+        await writer.close()
+
+    asyncio.run(run())
@@ -0,0 +1,117 @@
+import asyncio
+import random
+
+import pytest
+
+from inquirer_plugins.devices.teplocon_01 import device
+from inquirer_plugins.devices.teplocon_01.device import (
+    Crc16, TeploconCommon, ParityStreamReader, ParityStreamWriter, crc16
+)
+
+BUFFERS = [b'', b'\x00', b'\xff' * 7, bytes(range(256))] + [
+    random.Random(seed).randbytes(size) for seed, size in enumerate((1, 3, 24, 245, 1024, 4099))
+]
+
+BUFFER_TYPES = [bytes, bytearray, memoryview]
+
+
+def reference_crc(data):
+    """
+    Побитовый расчет CRC из прежней реализации TeploconCommon.compute_crc
+    """
+    crc = 0xffff
+
+    for item in data:
+        crc = crc ^ item
+        for count in range(8):
+            if crc & 0x1:
+                mask = 0xa001
+            else:
+                mask = 0x00
+            crc = ((crc >> 1) & 0x7FFF) ^ mask
+
+    return chr(crc & 0xFF).encode('latin-1') + chr((crc >> 8) & 0xFF).encode('latin-1')
+
+
+def reference_encode(data):
+    return bytes(byte | 0x80 if bin(byte).count('1') % 2 else byte for byte in data)
+
+
+def reference_decode(data):
+    return bytes(byte if bin(byte)[1:].count('1') % 2 else byte & 0x7F for byte in data)
+
+
+@pytest.fixture(params=['table', 'native'])
+def crc_engine(request, monkeypatch):
+    if request.param == 'table':
+        monkeypatch.setattr(device, '_crc16_native', None)
+    elif device._crc16_native is None:
+        pytest.skip('crcmod не установлен')
+
+    return request.param
+
+
+@pytest.mark.parametrize('buffer_type', BUFFER_TYPES)
+def test_crc16_matches_reference(crc_engine, buffer_type):
+    for data in BUFFERS:
+        expected = reference_crc(data)
+
+        assert crc16(buffer_type(data)) == expected
+        assert TeploconCommon.compute_crc(buffer_type(data)) == expected
+
+
+@pytest.mark.parametrize('buffer_type', BUFFER_TYPES)
+def test_crc16_incremental(crc_engine, buffer_type):
+    for data in BUFFERS:
+        for split in {0, 1, len(data) // 3, len(data) // 2, len(data)}:
+            crc = Crc16(buffer_type(data[:split])).update(buffer_type(data[split:]))
+
+            assert crc.digest() == reference_crc(data)
+
+
+def test_crc16_memoryview_slice(crc_engine):
+    data = BUFFERS[-1]
+
+    assert crc16(memoryview(data)[3:-2]) == reference_crc(data[3:-2])
+
+
+def test_crc16_residue(crc_engine):
+    for data in BUFFERS:
+        frame = bytearray(data + reference_crc(data))
+
+        assert Crc16(frame).check()
+
+        frame[len(frame) // 2] ^= 0x01
+        assert not Crc16(frame).check()
+
+
+@pytest.mark.parametrize('buffer_type', BUFFER_TYPES)
+def test_parity_matches_reference(buffer_type):
+    for data in BUFFERS:
+        assert TeploconCommon.encode(buffer_type(data)) == reference_encode(data)
+        assert TeploconCommon.decode(buffer_type(data)) == reference_decode(data)
+
+
+def test_parity_streams():
+    data = BUFFERS[-1]
+
+    class Writer:
+        def __init__(self):
+            self.written = b''
+
+        def write(self, chunk):
+            self.written += chunk
+
+    async def read_back():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+
+        stream = ParityStreamReader(reader)
+        return await stream.readexactly(100) + await stream.read()
+
+    writer = Writer()
+    ParityStreamWriter(writer).write(memoryview(data))
+
+    assert writer.written == reference_encode(data)
+    assert asyncio.run(read_back()) == reference_decode(data)
@@ -0,0 +1,37 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from inquirer_utils import get_report_date, relativedelta
+from inquirer_utils.headers import PERIOD_MONTH
+
+from inquirer_plugins import utils
+from inquirer_plugins.utils import derive_metrics
+
+
+def make_month_data(count, started=datetime(2020, 3, 1, 10)):
+    return [
+        {'metric_type': PERIOD_MONTH, 'event_time': started + timedelta(minutes=idx), 'metrics': {'1': {'tраб': 100}}}
+        for idx in range(count)
+    ]
+
+
+def test_report_date_cache_is_per_month():
+    utils._get_month_report_date.cache_clear()
+
+    data = make_month_data(50)
+    asyncio.run(derive_metrics(data, {'report_day': 25}))
+
+    info = utils._get_month_report_date.cache_info()
+    assert (info.hits, info.misses) == (49, 1)
+
+    from_date = get_report_date(datetime(2020, 2, 1), 25)
+    for item in data:
+        period_hours = (item['event_time'] - from_date).days * 24
+        assert item['metrics']['1']['tост'] == period_hours - 100
+
+
+def test_report_date_matches_uncached():
+    for moment in (datetime(2020, 1, 31, 23), datetime(2020, 2, 29), datetime(2021, 12, 1, 5)):
+        for report_day in (1, 15, 28, 31):
+            assert utils._get_report_date(moment - relativedelta(months=1), report_day) == \
+                get_report_date(moment - relativedelta(months=1), report_day)
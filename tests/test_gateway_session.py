@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from inquirer_plugins.devices.teplocon_01.device import GatewaySession
+
+
+async def open_session():
+    server = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    return server, await GatewaySession.get('127.0.0.1', port).acquire()
+
+
+async def exchange(result, delay=0.05, error=None):
+    await asyncio.sleep(delay)
+
+    if error is not None:
+        raise error
+
+    return result
+
+
+@pytest.mark.parametrize('error', [None, ValueError('bad frame')])
+def test_cancelled_request_keeps_worker(error):
+    async def run():
+        server, session = await open_session()
+
+        try:
+            cancelled = asyncio.ensure_future(session.request(exchange, 1, 0.05, error))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+
+            assert await asyncio.wait_for(session.request(exchange, 2, 0), 1) == 2
+            assert not session._worker.done()
+        finally:
+            await session.release()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_request_errors_are_delivered():
+    async def run():
+        server, session = await open_session()
+
+        try:
+            with pytest.raises(ValueError):
+                await session.request(exchange, 1, 0, ValueError('bad frame'))
+
+            assert session.broken
+            assert await asyncio.wait_for(session.request(exchange, 2, 0), 1) == 2
+        finally:
+            await session.release()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_late_reply_is_not_taken_by_next_device():
+    from inquirer_plugins.devices.teplocon_01.device import Device, ResponseTimeoutException, SETTINGS_CODEC, crc16
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await reader.read(64)
+
+                if not request:
+                    break
+
+                # Прибор 1 отвечает после таймаута, серийный номер совпадает с номером прибора
+                if request[0] == 1:
+                    await asyncio.sleep(0.6)
+
+                values = [0.0] * 3 + [0] * 15
+                values[1] = float(request[0])
+                frame = bytes(request[:2]) + bytes([SETTINGS_CODEC.size]) + SETTINGS_CODEC.struct.pack(*values)
+
+                writer.write(frame + crc16(frame))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        devices = [Device(dev_id=str(dev_num), ip='127.0.0.1', port=port, dev_num=dev_num) for dev_num in (1, 2)]
+
+        try:
+            for device in devices:
+                device._session = await GatewaySession.get('127.0.0.1', port).acquire()
+
+            first = asyncio.ensure_future(devices[0].read_metrics(0, type_metrics='read_settings'))
+            await asyncio.sleep(0.01)
+            second = asyncio.ensure_future(devices[1].read_metrics(0, type_metrics='read_settings'))
+
+            with pytest.raises(ResponseTimeoutException):
+                await first
+
+            assert (await second)['serial'] == '2'
+
+            # Поздний ответ прибора 1 остался в закрытом соединении
+            await asyncio.sleep(0.7)
+            assert (await devices[1].read_metrics(1, type_metrics='read_settings'))['serial'] == '2'
+        finally:
+            for device in devices:
+                await device.close_async()
+
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_frame_header_must_match_request():
+    from inquirer_plugins.devices.teplocon_01.device import Device, ResponseParseException, crc16
+
+    frame = bytes([1, 0x01, 2, 0xAA, 0xBB])
+    frame += crc16(frame)
+
+    assert bytes(Device._check_frame(frame, bytes([1, 0x01, 0]))) == b'\xaa\xbb'
+
+    for request in (bytes([2, 0x01, 0]), bytes([1, 0x02, 0])):
+        with pytest.raises(ResponseParseException):
+            Device._check_frame(frame, request)
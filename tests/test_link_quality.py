@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from inquirer_plugins.devices.teplocon_01.device import LinkQuality, ResponseTimeoutException, TeploconCommon
+from inquirer_plugins.devices.teplocon_01.headers import LINK_RTO_MAX
+
+
+def test_timeout_without_samples_backs_off():
+    async def run():
+        common = TeploconCommon('127.0.0.1', 0)
+        # Прибор не отвечает: канал медленнее таймаута по умолчанию
+        common._reader = asyncio.StreamReader()
+        initial = common.reply_timeout()
+
+        with pytest.raises(ResponseTimeoutException):
+            await common.receive_async(10)
+
+        assert common.link.rto == pytest.approx(2 * initial)
+        assert common.reply_timeout() == pytest.approx(2 * initial)
+        assert common.link.changed
+
+    asyncio.run(run())
+
+
+def test_backoff_is_bounded_and_reset_by_sample():
+    link = LinkQuality()
+
+    for _ in range(10):
+        link.backoff(0.5)
+
+    assert link.rto == LINK_RTO_MAX
+
+    link.observe(1.2, 0, 0)
+    assert link.rto < LINK_RTO_MAX
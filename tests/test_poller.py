@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+import pytest
+from inquirer_utils.headers import INTEGRAL_DAY, INTEGRAL_HOUR, INTEGRAL_MONTH, PERIOD_CURRENT
+
+from inquirer_plugins.poller import DueScheduler
+
+DELAY = timedelta(minutes=5)
+
+
+@pytest.fixture
+def scheduler():
+    return DueScheduler(current_interval=600, due_delay=DELAY.total_seconds())
+
+
+@pytest.mark.parametrize('metric_type, polled_at, report_day, due_date', [
+    (INTEGRAL_MONTH, datetime(2020, 2, 20, 10, 30), 25, datetime(2020, 2, 25)),
+    (INTEGRAL_MONTH, datetime(2020, 2, 26, 10, 30), 25, datetime(2020, 3, 25)),
+    (INTEGRAL_DAY, datetime(2020, 2, 20, 10, 30), 31, datetime(2020, 2, 21)),
+    (INTEGRAL_HOUR, datetime(2020, 2, 20, 10, 30), 31, datetime(2020, 2, 20, 11)),
+    (INTEGRAL_HOUR, datetime(2020, 2, 20, 23, 0), 31, datetime(2020, 2, 21)),
+])
+def test_due_date_is_next_period_boundary(scheduler, metric_type, polled_at, report_day, due_date):
+    assert scheduler.get_due_date(metric_type, polled_at, report_day) == due_date + DELAY
+
+
+def test_due_date_follows_last_record(scheduler):
+    polled_at = datetime(2020, 2, 20, 10, 30)
+
+    # Последняя запись за прошедшие сутки: следующая появится на ближайшей границе
+    assert scheduler.get_due_date(INTEGRAL_DAY, polled_at, last_date=datetime(2020, 2, 20)) == \
+        datetime(2020, 2, 21) + DELAY
+
+    # Прибор отстает: недостающая запись ожидается не раньше следующей границы после опроса
+    assert scheduler.get_due_date(INTEGRAL_HOUR, polled_at, last_date=datetime(2020, 2, 20, 6)) == \
+        datetime(2020, 2, 20, 11) + DELAY
+
+
+def test_current_metrics_use_interval(scheduler):
+    polled_at = datetime(2020, 2, 20, 10, 30)
+
+    assert scheduler.get_due_date(PERIOD_CURRENT, polled_at) == polled_at + timedelta(seconds=600)
+
+
+def test_sleep_until_next_due(monkeypatch, scheduler):
+    from inquirer_plugins import poller
+    from inquirer_plugins.poller import FleetPoller
+
+    polled_at = datetime(2020, 2, 20, 10, 30)
+    monkeypatch.setattr(poller, 'now', lambda: polled_at)
+
+    fleet = FleetPoller(None, scheduler=scheduler)
+    assert fleet.get_sleep_time(3600, 60) == 3540
+
+    # Ближайшая граница часа с задержкой на запись архива
+    scheduler.schedule('1', INTEGRAL_HOUR, scheduler.get_due_date(INTEGRAL_HOUR, polled_at))
+    assert fleet.get_sleep_time(3600, 60) == (datetime(2020, 2, 20, 11) + DELAY - polled_at).total_seconds()
+
+    scheduler.schedule('1', INTEGRAL_HOUR, polled_at - timedelta(minutes=1))
+    assert fleet.get_sleep_time(3600, 60) == 1
+
+    assert FleetPoller(None).get_sleep_time(3600, 4000) == 0
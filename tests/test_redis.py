@@ -0,0 +1,179 @@
+import asyncio
+import uuid
+
+import pytest
+
+from inquirer_plugins import base, utils
+from inquirer_plugins.base import LOCK_RENEW_SCRIPT, Base
+from inquirer_plugins.utils import REDIS_CACHE_DB, ConnectionPool, check_lock, redis_pools
+
+
+def run_with_redis(test):
+    """
+    Запуск теста с пулами Redis из REDIS_URL, без доступного Redis тест пропускается
+    """
+    async def run():
+        try:
+            await asyncio.wait_for(redis_pools.get(), 2)
+        except (OSError, asyncio.TimeoutError) as e:
+            await redis_pools.close()
+            pytest.skip(f'Redis недоступен ({utils.REDIS_URL}): {e}')
+
+        try:
+            await test()
+        finally:
+            await redis_pools.close()
+
+    asyncio.run(run())
+
+
+async def make_device(dev_id):
+    device = Base(dev_id)
+    device.cache = await redis_pools.get()
+
+    return device
+
+
+async def cleanup(device):
+    await device.cache.delete(
+        f'locks:{device.lock_key}', f'locks:{device.lock_key}:token', f'locks:{device.lock_key}:released'
+    )
+
+
+def test_redis_pools_are_shared():
+    async def test():
+        cache = await redis_pools.get()
+        blocking = await redis_pools.get(REDIS_CACHE_DB, blocking=True)
+
+        assert await redis_pools.get() is cache
+        assert blocking is not cache
+        assert await cache.ping() == b'PONG'
+
+        info = redis_pools.info()
+        assert set(info['pools']) == {f'{REDIS_CACHE_DB}', f'{REDIS_CACHE_DB}:blocking'}
+
+    run_with_redis(test)
+
+
+def test_lock_scripts():
+    async def test():
+        dev_id = uuid.uuid4().hex
+        first, second = await make_device(dev_id), await make_device(dev_id)
+
+        try:
+            token = await first.lock_connect()
+            assert token
+            assert (await first.get_lock_info())['owner'] == first.lock_owner
+
+            # Занятая блокировка не выдается другому владельцу, повторный захват владельцем возвращает тот же токен
+            assert not await second.lock_connect()
+            assert await first.lock_connect() == token
+
+            # Продление под чужим токеном не проходит
+            assert not await first.cache.eval(
+                LOCK_RENEW_SCRIPT, keys=[f'locks:{dev_id}'], args=[token + 1, 1000]
+            )
+
+            await first.unlock_connect()
+            assert await first.get_lock_info() is None
+
+            # Ожидающий получает сигнал об освобождении без ожидания таймаута
+            assert await asyncio.wait_for(second.wait_unlock(5), 1)
+
+            # Следующий владелец получает больший токен
+            assert await second.lock_connect() > token
+
+            # Снятие по устаревшему токену не затрагивает нового владельца
+            first.lock_token = token
+            await first.unlock_connect()
+            assert (await second.get_lock_info())['owner'] == second.lock_owner
+
+            await second.unlock_connect()
+        finally:
+            for device in (first, second):
+                if device._lock_renewal is not None:
+                    device._lock_renewal.cancel()
+
+            await cleanup(first)
+
+    run_with_redis(test)
+
+
+def test_lock_lost_on_renew_error(monkeypatch):
+    class BrokenCache:
+        async def eval(self, *args, **kwargs):
+            raise ConnectionError('Redis is down')
+
+    monkeypatch.setattr(base, 'CACHE_TTL', 0.03)
+
+    async def test():
+        device = Base(uuid.uuid4().hex)
+        device.cache, device.lock_token = BrokenCache(), 1
+
+        await asyncio.wait_for(device._renew_lock(), 1)
+
+        assert device.lock_lost
+        with pytest.raises(utils.DeviceException):
+            device.check_lease()
+
+    asyncio.run(test())
+
+
+def test_hung_poll_releases_lock(monkeypatch):
+    monkeypatch.setattr(utils, 'LOCK_LEASE_MAX', 0.05)
+
+    class Device(Base):
+        released = False
+
+        async def lock_connect(self):
+            return 1
+
+        async def unlock_connect(self):
+            self.released = True
+
+        @check_lock
+        async def poll(self):
+            await asyncio.sleep(10)
+
+    async def test():
+        device = Device(uuid.uuid4().hex)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await device.poll()
+
+        assert device.released
+        assert device.lock_depth == 0
+
+    asyncio.run(test())
+
+
+def test_connection_pool_lease_and_release():
+    async def test():
+        server = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        pool = ConnectionPool(max_size=1)
+
+        try:
+            streams = await pool.lease('127.0.0.1', port)
+            pool.release('127.0.0.1', port, *streams)
+
+            assert await pool.lease('127.0.0.1', port) == streams
+            assert pool.stats['hits'] == 1
+
+            # Соединение после ошибки обмена закрывается, а не возвращается в пул
+            pool.release('127.0.0.1', port, *streams, reuse=False)
+            assert len(pool) == 0
+            assert streams[1].is_closing()
+
+            other = await pool.lease('127.0.0.1', port)
+            extra = await pool.lease('127.0.0.1', port)
+            pool.release('127.0.0.1', port, *other)
+            pool.release('127.0.0.1', port, *extra)
+
+            assert len(pool) == 1
+            assert pool.stats['evicted'] == 1
+        finally:
+            pool.close()
+            server.close()
+
+    asyncio.run(test())
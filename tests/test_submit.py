@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from inquirer_plugins import utils
+from inquirer_plugins.utils import filter_last_date, submit_response
+
+STARTED = datetime(2020, 1, 1)
+
+
+def make_data(count, metric_type='integral_hour'):
+    return [
+        {'metric_type': metric_type, 'event_time': STARTED + timedelta(hours=idx), 'metrics': {'1': {}}}
+        for idx in range(count)
+    ]
+
+
+class Device:
+    dev_id = '1'
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.submitted = []
+        self.last_event_times = {}
+
+    def check_lease(self):
+        pass
+
+    async def func(self, service, method, dev_id, data):
+        self.submitted.append(data)
+
+    @submit_response(is_sorted=True)
+    async def process_sorted(self, last_date):
+        for page in self.pages:
+            yield {'data': page}
+
+    @submit_response
+    async def process_unsorted(self, last_date):
+        return {'data': [item for page in self.pages for item in reversed(page)]}
+
+
+@pytest.mark.parametrize('cutoff', [-1, 0, 1, 499, 999, 1000])
+def test_sorted_filter_matches_single_pass(cutoff):
+    data = make_data(1000)
+    last_date = STARTED + timedelta(hours=cutoff)
+
+    assert filter_last_date(data, last_date, is_sorted=True) == filter_last_date(data, last_date)
+
+
+@pytest.mark.parametrize('method', ['process_sorted', 'process_unsorted'])
+def test_submit_response_drops_submitted_records(monkeypatch, method):
+    monkeypatch.setattr(utils, 'DONT_SUBMIT', False)
+
+    data = make_data(600)
+    device = Device([data[:300], data[300:]])
+
+    asyncio.run(getattr(device, method)(last_date=data[449]['event_time']))
+
+    submitted = [item for chunk in device.submitted for item in chunk['data']]
+
+    assert sorted(item['event_time'] for item in submitted) == [item['event_time'] for item in data[450:]]
+    assert device.last_event_times == {'integral_hour': data[-1]['event_time']}
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_queued_submit_confirmation(monkeypatch, fail):
+    from inquirer_plugins.base import Base
+
+    monkeypatch.setattr(utils, 'DONT_SUBMIT', False)
+    monkeypatch.setattr(utils, 'submit_queue', utils.SubmitQueue(workers=1))
+
+    class QueuedDevice(Base):
+        def __init__(self):
+            super().__init__('1', func=self.submit)
+            self.cursor = None
+
+        async def submit(self, service, method, dev_id, data):
+            await asyncio.sleep(0.01)
+
+            if fail:
+                raise ConnectionError('DeviceSubmitter is down')
+
+        @submit_response(is_sorted=True)
+        async def process(self, last_date):
+            for narc, page in enumerate((make_data(3), make_data(3)), 1):
+                yield {'data': page}
+
+                if not await self.confirm_submitted():
+                    return
+
+                self.cursor = narc
+
+    async def run():
+        device = QueuedDevice()
+        await device.process(last_date=None)
+        await utils.submit_queue.close()
+
+        return device
+
+    device = asyncio.run(run())
+
+    assert device.cursor == (None if fail else 2)
+    assert len(utils.submit_queue.pop_failures()) == (1 if fail else 0)
+
+
+def test_submit_failures_are_bounded(monkeypatch):
+    monkeypatch.setattr(utils, 'DONT_SUBMIT', False)
+
+    async def submit(service, method, dev_id, data):
+        raise ConnectionError('DeviceSubmitter is down')
+
+    async def run():
+        queue = utils.SubmitQueue(workers=1, failures_max=3)
+        futures = [await queue.put(submit, str(idx), {}) for idx in range(5)]
+
+        assert await asyncio.gather(*futures) == [False] * 5
+        await queue.close()
+
+        return queue
+
+    queue = asyncio.run(run())
+
+    assert queue.stats['failed'] == 5
+    assert [dev_id for dev_id, _ in queue.pop_failures()] == ['2', '3', '4']
+    assert queue.pop_failures() == []
+
+
+def test_pending_submits_cleared_after_call(monkeypatch):
+    monkeypatch.setattr(utils, 'DONT_SUBMIT', False)
+    monkeypatch.setattr(utils, 'submit_queue', utils.SubmitQueue(workers=1))
+
+    async def run():
+        device = Device([make_data(3)])
+        device.pending_submits = []
+
+        await device.process_sorted(last_date=None)
+        await utils.submit_queue.close()
+
+        return device
+
+    device = asyncio.run(run())
+
+    assert device.pending_submits == []
+    assert len(device.submitted) == 1
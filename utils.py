@@ -1,9 +1,16 @@
 import asyncio
+import bisect
+import functools
+import inspect
 import json
 import os
-import pickle
+import random
+import sys
+from collections import OrderedDict, deque
+from datetime import datetime
 
 import aioredis
+import msgpack
 from async_timeout import timeout
 from inquirer_utils import get_report_date, relativedelta, delta
 from inquirer_utils.headers import LOCK_TTL, ROUND_CNT, PERIOD, HOUR, DAY, MONTH, CURRENT
@@ -12,6 +19,52 @@ from is74_utils import DateTimeEncoder, now, logger
 DEVICE_SUBMITTER = os.environ.get('DEVICE_SUBMITTER', 'DeviceSubmitter')
 DONT_SUBMIT = bool(os.environ.get('DONT_SUBMIT', False))
 MAX_SUBMIT_COUNT = 250
+SUBMIT_WORKERS = int(os.environ.get('SUBMIT_WORKERS', 0))   # 0 - передача без очереди
+SUBMIT_QUEUE_SIZE = int(os.environ.get('SUBMIT_QUEUE_SIZE', 1000))
+SUBMIT_FAILURES_MAX = int(os.environ.get('SUBMIT_FAILURES_MAX', 1000))     # Хранимые ошибки передачи до отчета
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://partner-redis')
+REDIS_POOL_MIN_SIZE = int(os.environ.get('REDIS_POOL_MIN_SIZE', 1))
+REDIS_POOL_MAX_SIZE = int(os.environ.get('REDIS_POOL_MAX_SIZE', 20))
+REDIS_BLOCKING_POOL_MAX_SIZE = int(os.environ.get('REDIS_BLOCKING_POOL_MAX_SIZE', 100))
+REDIS_CACHE_DB = 0
+REDIS_RESPONSE_DB = 1
+
+LOCK_SIGNAL_TTL = 5     # Время жизни сигнала об освобождении блокировки, сек
+LOCK_WAIT_MAX = 8       # Максимальное ожидание сигнала об освобождении блокировки, сек
+LOCK_LEASE_MAX = int(os.environ.get('LOCK_LEASE_MAX', 30 * 60))   # Максимальное время владения блокировкой, сек
+
+MSGPACK_DATETIME = 1    # Код расширения msgpack для datetime
+
+WRAP_YIELD_EVERY = 200          # Передача управления циклу событий каждые N записей
+WRAP_YIELD_INTERVAL = 0.005     # или каждые M секунд
+
+# Тройки ключей (прямой, обратный, разность) для расчета разностей
+DERIVED_METRICS = tuple(
+    (sys.intern(f'{metric}1'), sys.intern(f'{metric}2'), sys.intern(f'{metric}d')) for metric in 'TVMPQG'
+)
+
+# Ответ записывается, только пока ожидающий держит ключ
+SET_RESPONSE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return 1
+end
+
+return 0
+"""
+
+# Освобождение ключа ожидания и сигнал следующему ожидающему
+RELEASE_RESPONSE_SCRIPT = """
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+redis.call('RPUSH', KEYS[3], 1)
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+"""
+
+POOL_MAX_SIZE = int(os.environ.get('POOL_MAX_SIZE', 100))
+POOL_IDLE_TIMEOUT = float(os.environ.get('POOL_IDLE_TIMEOUT', 60))
+POOL_CONNECT_TIMEOUT = float(os.environ.get('POOL_CONNECT_TIMEOUT', 10))
 
 MODEL_NAMES = {
     'карат 306': 'karat_30x',
@@ -44,28 +97,301 @@ MODEL_NAMES = {
 }
 
 
+class ConnectionPool:
+    """
+    Пул простаивающих TCP-соединений с устройствами, ключ - (ip, port).
+    Соединения закрываются по простою и по LRU при превышении размера пула
+    """
+
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, connect_timeout=POOL_CONNECT_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+
+        # writer -> (key, reader, released_at), от давно освобожденных к недавним
+        self._idle = OrderedDict()
+        self._sweeper = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evicted': 0,
+            'broken': 0,
+        }
+
+    def __len__(self):
+        return len(self._idle)
+
+    @staticmethod
+    def is_healthy(reader, writer):
+        return not writer.is_closing() and not reader.at_eof() and reader.exception() is None
+
+    async def lease(self, ip, port):
+        key = (ip, port)
+
+        self._evict_expired()
+
+        for writer, (idle_key, reader, _) in reversed(self._idle.items()):
+            if idle_key != key:
+                continue
+
+            del self._idle[writer]
+
+            if self.is_healthy(reader, writer):
+                self.stats['hits'] += 1
+                return reader, writer
+
+            self.stats['broken'] += 1
+            writer.close()
+            break
+
+        self.stats['misses'] += 1
+
+        return await asyncio.wait_for(asyncio.open_connection(ip, port), self.connect_timeout)
+
+    def release(self, ip, port, reader, writer, reuse=True):
+        if not reuse or not self.is_healthy(reader, writer):
+            writer.close()
+            return
+
+        self._idle[writer] = ((ip, port), reader, asyncio.get_event_loop().time())
+
+        while len(self._idle) > self.max_size:
+            old_writer, _ = self._idle.popitem(last=False)
+            old_writer.close()
+            self.stats['evicted'] += 1
+
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep())
+
+    def _evict_expired(self):
+        deadline = asyncio.get_event_loop().time() - self.idle_timeout
+
+        while self._idle:
+            writer, (_, _, released_at) = next(iter(self._idle.items()))
+
+            if released_at > deadline:
+                break
+
+            del self._idle[writer]
+            writer.close()
+            self.stats['expired'] += 1
+
+    async def _sweep(self):
+        while self._idle:
+            await asyncio.sleep(self.idle_timeout)
+            self._evict_expired()
+
+    def close(self):
+        for writer in self._idle:
+            writer.close()
+
+        self._idle.clear()
+
+
+connection_pool = ConnectionPool()
+
+
+class RedisPools:
+    """
+    Общие для процесса пулы соединений с Redis по номерам баз, создаются при первом обращении
+    """
+
+    def __init__(self, url=REDIS_URL, minsize=REDIS_POOL_MIN_SIZE, maxsize=REDIS_POOL_MAX_SIZE,
+                 blocking_maxsize=REDIS_BLOCKING_POOL_MAX_SIZE):
+        self.url = url
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.blocking_maxsize = blocking_maxsize
+
+        self._pools = {}
+        self._lock = None
+
+        self.stats = {
+            'requests': 0,
+            'created': 0,
+            'reconnects': 0,
+        }
+
+    async def get(self, db=REDIS_CACHE_DB, blocking=False):
+        """
+        Пул для блокирующих команд (BLPOP) отделен, чтобы ожидание не занимало соединения общего пула
+        """
+        self.stats['requests'] += 1
+
+        key = (db, blocking)
+        pool = self._pools.get(key)
+
+        if pool is not None and not pool.closed:
+            return pool
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            pool = self._pools.get(key)
+
+            if pool is None or pool.closed:
+                if pool is not None:
+                    self.stats['reconnects'] += 1
+
+                self._pools[key] = await aioredis.create_redis_pool(
+                    f'{self.url}/{db}', minsize=self.minsize,
+                    maxsize=self.blocking_maxsize if blocking else self.maxsize
+                )
+                self.stats['created'] += 1
+
+        return self._pools[key]
+
+    def info(self):
+        return {
+            **self.stats,
+            'pools': {
+                f'{db}{":blocking" if blocking else ""}': {
+                    'size': pool.connection.size,
+                    'freesize': pool.connection.freesize,
+                }
+                for (db, blocking), pool in self._pools.items() if not pool.closed
+            },
+        }
+
+    async def close(self):
+        pools, self._pools = self._pools, {}
+
+        for pool in pools.values():
+            pool.close()
+            await pool.wait_closed()
+
+
+redis_pools = RedisPools()
+
+
+async def wait_signal(key, wait_time, db=REDIS_CACHE_DB):
+    """
+    Ожидание сигнала в списке key не дольше wait_time секунд (BLPOP)
+    """
+    redis = await redis_pools.get(db, blocking=True)
+
+    with await redis as conn:
+        return await conn.blpop(key, timeout=wait_time)
+
+
+def lock_backoff(attempt):
+    # Экспоненциальная задержка со случайным разбросом, целые секунды для BLPOP
+    return max(1, round(min(LOCK_WAIT_MAX, 2 ** attempt) * random.uniform(0.5, 1)))
+
+
+class SubmitQueue:
+    """
+    Фоновая передача данных в DeviceSubmitter ограниченным числом обработчиков.
+    Все пачки одного устройства передает один и тот же обработчик, поэтому порядок сохраняется
+    """
+
+    def __init__(self, workers=SUBMIT_WORKERS, max_size=SUBMIT_QUEUE_SIZE, failures_max=SUBMIT_FAILURES_MAX):
+        self.workers = workers
+        self.max_size = max_size
+
+        self._queues = []
+        self._tasks = []
+
+        # Последние ошибки передачи: без вызова pop_failures старые вытесняются, все учитываются в stats
+        self.failures = deque(maxlen=failures_max)
+        self.stats = {
+            'submitted': 0,
+            'failed': 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _start(self):
+        self._queues = [asyncio.Queue(max(1, self.max_size // self.workers)) for _ in range(self.workers)]
+        self._tasks = [asyncio.ensure_future(self._process(queue)) for queue in self._queues]
+
+    async def put(self, func, dev_id, data):
+        """
+        Постановка пачки в очередь, при заполненной очереди ожидает освобождения места.
+        Возвращает future с результатом передачи: True - передана, False - ошибка
+        """
+        if not self._tasks:
+            self._start()
+
+        future = asyncio.get_event_loop().create_future()
+        await self._queues[hash(dev_id) % self.workers].put((func, dev_id, data, future))
+
+        return future
+
+    async def _process(self, queue):
+        while True:
+            func, dev_id, data, future = await queue.get()
+            submitted = False
+
+            try:
+                await func(DEVICE_SUBMITTER, 'submit', dev_id=dev_id, data=data)
+                self.stats['submitted'] += 1
+                submitted = True
+            except Exception as e:
+                self.stats['failed'] += 1
+                self.failures.append((dev_id, e))
+                logger.error(f'{dev_id}: ошибка передачи данных: {e}')
+            finally:
+                if not future.done():
+                    future.set_result(submitted)
+
+                queue.task_done()
+
+    def pop_failures(self):
+        failures = list(self.failures)
+        self.failures.clear()
+
+        return failures
+
+    async def join(self):
+        for queue in self._queues:
+            await queue.join()
+
+    async def close(self):
+        await self.join()
+
+        for task in self._tasks:
+            task.cancel()
+
+        self._queues, self._tasks = [], []
+
+
+submit_queue = SubmitQueue()
+
+
 def check_lock(func):
     async def wrapper(self, *args, **kwargs):
-        async with timeout(LOCK_TTL):
-            need_unlock = True
+        # Вложенный вызов под уже захваченной блокировкой не обращается к Redis
+        if self.lock_depth:
+            self.lock_depth += 1
 
-            while True:
-                if not await self.lock_connect():
-                    info = await self.get_lock_info()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                self.lock_depth -= 1
 
-                    if info['id'] != id(self):
-                        await asyncio.sleep(1)
-                        continue
+        async with timeout(LOCK_TTL):
+            attempt = 0
 
-                    need_unlock = False
+            while not await self.lock_connect():
+                # Ждем сигнала от unlock_connect, при его пропуске - повтор с нарастающей задержкой
+                if not await self.wait_unlock(lock_backoff(attempt)):
+                    attempt += 1
 
-                try:
-                    response = await func(self, *args, **kwargs)
-                finally:
-                    if need_unlock:
-                        await self.unlock_connect()
+        self.lock_depth = 1
 
-                return response
+        try:
+            # Блокировка продлевается, пока идет опрос: зависший опрос прерывается по общему сроку владения
+            async with timeout(LOCK_LEASE_MAX):
+                return await func(self, *args, **kwargs)
+        finally:
+            self.lock_depth = 0
+            await self.unlock_connect()
 
     return wrapper
 
@@ -91,57 +417,97 @@ def connect(func):
     return wrapper
 
 
-def wrap_response(func):
-    async def wrapper(self, *args, **kwargs):
-        response = {}
+def _iterate_responses(func):
+    """
+    Обертка для process_*, написанных как асинхронные генераторы страниц:
+    каждая страница проходит цепочку декораторов отдельно
+    """
+    def decorator(handler):
+        if inspect.isasyncgenfunction(func):
+            async def gen_wrapper(self, *args, **kwargs):
+                async for data in func(self, *args, **kwargs):
+                    response = await handler(self, data)
 
-        data = await func(self, *args, **kwargs)
+                    if response:
+                        yield response
 
-        if not data:
-            return {}
+            return gen_wrapper
 
-        scheme = await self.get_scheme()
+        async def wrapper(self, *args, **kwargs):
+            return await handler(self, await func(self, *args, **kwargs))
 
-        for metric_item in data:
-            await asyncio.sleep(0)
+        return wrapper
 
-            metric_type = metric_item['metric_type']
-            event_time = metric_item['event_time']
+    return decorator
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_month_report_date(year, month, report_day, tzinfo=None):
+    return get_report_date(datetime(year, month, 1, tzinfo=tzinfo), report_day)
+
+
+def _get_report_date(moment, report_day):
+    # Расчетная дата зависит только от месяца, кэш по (год, месяц, расчетный день)
+    return _get_month_report_date(moment.year, moment.month, report_day, moment.tzinfo)
 
-            for ss_num, metrics in metric_item['metrics'].items():
-                for metric in 'TVMPQG':
-                    m1 = f'{metric}1'
-                    m2 = f'{metric}2'
-                    md = f'{metric}d'
 
-                    if all(x in metrics for x in (m1, m2)) and md not in metrics:
-                        metrics[md] = round(metrics[m1] - metrics[m2], ROUND_CNT)
+def _get_period_hours(metric_type, event_time, scheme):
+    if HOUR in metric_type:
+        return 1.0
+    elif DAY in metric_type:
+        return 24.0
+    elif MONTH in metric_type:
+        from_date = _get_report_date(event_time - relativedelta(months=1), scheme['report_day'])
+        return (event_time - from_date).days * 24
 
-                if PERIOD in metric_type:
-                    if 'tраб' not in metrics or 'tост' in metrics:
-                        continue
 
-                    t_ost = None
-                    t_rab = metrics['tраб']
+async def derive_metrics(data, scheme):
+    """
+    Расчет разностей (*d) и времени простоя (tост) для пачки записей
+    """
+    loop = asyncio.get_event_loop()
+    next_yield = loop.time() + WRAP_YIELD_INTERVAL
+    is_period = {}
 
-                    if HOUR in metric_type:
-                        t_ost = 1.0 - t_rab
-                    elif DAY in metric_type:
-                        t_ost = 24.0 - t_rab
-                    elif MONTH in metric_type:
-                        from_date = get_report_date(event_time - relativedelta(months=1), scheme['report_day'])
-                        delta_hours = (event_time - from_date).days * 24
-                        t_ost = delta_hours - t_rab
+    for idx, metric_item in enumerate(data, 1):
+        metric_type = metric_item['metric_type']
 
-                    if t_ost is not None:
-                        metrics['tост'] = round(t_ost, ROUND_CNT)
+        if metric_type not in is_period:
+            is_period[metric_type] = PERIOD in metric_type
 
-        if data:
-            for field in ('current_time', 'serial', 'subsystems'):
-                if field in scheme:
-                    response[field] = scheme[field]
+        for metrics in metric_item['metrics'].values():
+            for m1, m2, md in DERIVED_METRICS:
+                if m1 in metrics and m2 in metrics and md not in metrics:
+                    metrics[md] = round(metrics[m1] - metrics[m2], ROUND_CNT)
 
-            response['data'] = data
+            if is_period[metric_type] and 'tраб' in metrics and 'tост' not in metrics:
+                period_hours = _get_period_hours(metric_type, metric_item['event_time'], scheme)
+
+                if period_hours is not None:
+                    metrics['tост'] = round(period_hours - metrics['tраб'], ROUND_CNT)
+
+        if idx % WRAP_YIELD_EVERY == 0 or loop.time() >= next_yield:
+            await asyncio.sleep(0)
+            next_yield = loop.time() + WRAP_YIELD_INTERVAL
+
+
+def wrap_response(func):
+    @_iterate_responses(func)
+    async def wrapper(self, data):
+        response = {}
+
+        if not data:
+            return {}
+
+        scheme = await self.get_scheme()
+
+        await derive_metrics(data, scheme)
+
+        for field in ('current_time', 'serial', 'subsystems'):
+            if field in scheme:
+                response[field] = scheme[field]
+
+        response['data'] = data
 
         return response
 
@@ -149,9 +515,8 @@ def wrap_response(func):
 
 
 def check_response(func):
-    async def wrapper(self, *args, **kwargs):
-        response = await func(self, *args, **kwargs)
-
+    @_iterate_responses(func)
+    async def wrapper(self, response):
         if response and 'serial' in response and hasattr(self, 'serial'):
             if self.serial and str(self.serial).strip() != str(response['serial']).strip():
                 raise DeviceException(f'Не совпадают серийные номера на устройстве {response["serial"]} '
@@ -162,36 +527,92 @@ def check_response(func):
     return wrapper
 
 
-def submit_response(func):
-    async def wrapper(self, *args, **kwargs):
-        response = await func(self, *args, **kwargs)
-        last_date = kwargs.get('last_date')
+class _EventTimes:
+    """
+    Представление списка записей как последовательности event_time для bisect
+    """
+    __slots__ = ('data',)
 
-        if response and last_date:
-            for item in response['data']:
-                if item['event_time'] > last_date:
-                    break
+    def __init__(self, data):
+        self.data = data
 
-                response['data'].remove(item)
+    def __len__(self):
+        return len(self.data)
 
-        if not response or not response['data']:
-            return
+    def __getitem__(self, idx):
+        return self.data[idx]['event_time']
+
+
+def filter_last_date(data, last_date, is_sorted=False):
+    """
+    Отбрасывает записи с event_time не новее last_date.
+    Для упорядоченных по event_time данных граница ищется бинарным поиском
+    """
+    if not last_date or not data:
+        return data
+
+    if is_sorted:
+        return data[bisect.bisect_right(_EventTimes(data), last_date):]
+
+    return [item for item in data if item['event_time'] > last_date]
 
-        template = {key: value for key, value in response.items() if key != 'data'}
-        data = response['data']
 
-        for idx in range(0, len(data), MAX_SUBMIT_COUNT):
-            template['data'] = data[idx: idx + MAX_SUBMIT_COUNT]
+def submit_response(func=None, *, is_sorted=False):
+    """
+    Передача ответа в DeviceSubmitter. Для process_*, возвращающих записи по возрастанию event_time,
+    используется @submit_response(is_sorted=True): отсечение по last_date бинарным поиском
+    """
+    if func is None:
+        return functools.partial(submit_response, is_sorted=is_sorted)
 
-            # Для отладки
-            if DONT_SUBMIT:
-                print('Response:', json.dumps(template, cls=DateTimeEncoder))
+    async def wrapper(self, *args, **kwargs):
+        last_date = kwargs.get('last_date')
+
+        try:
+            if inspect.isasyncgenfunction(func):
+                async for response in func(self, *args, **kwargs):
+                    await _submit(self, response, last_date, is_sorted)
             else:
-                await self.func(DEVICE_SUBMITTER, 'submit', dev_id=self.dev_id, data=template)
+                await _submit(self, await func(self, *args, **kwargs), last_date, is_sorted)
+        finally:
+            # Неподтвержденные результаты передачи не переходят в следующий вызов,
+            # ошибки остаются в submit_queue.failures
+            self.pending_submits = []
 
     return wrapper
 
 
+async def _submit(device, response, last_date, is_sorted=False):
+    if response and last_date:
+        response['data'] = filter_last_date(response['data'], last_date, is_sorted)
+
+    if not response or not response['data']:
+        return
+
+    device.check_lease()
+
+    template = {key: value for key, value in response.items() if key != 'data'}
+    data = response['data']
+
+    # Время последней переданной записи по типам метрик - от него считается срок следующего опроса
+    for item in data:
+        last_event_time = device.last_event_times.get(item['metric_type'])
+
+        if last_event_time is None or item['event_time'] > last_event_time:
+            device.last_event_times[item['metric_type']] = item['event_time']
+
+    for idx in range(0, len(data), MAX_SUBMIT_COUNT):
+        chunk = {**template, 'data': data[idx: idx + MAX_SUBMIT_COUNT]}
+
+        # Для отладки
+        if DONT_SUBMIT:
+            print('Response:', json.dumps(chunk, cls=DateTimeEncoder))
+        elif submit_queue.enabled:
+            device.pending_submits.append(await submit_queue.put(device.func, device.dev_id, chunk))
+        else:
+            await device.func(DEVICE_SUBMITTER, 'submit', dev_id=device.dev_id, data=chunk)
+
+
 def repeat_with_exception(repeat_count=1, log_exception=True):
     def decorator(func):
         async def wrapper(self, *args, **kwargs):
@@ -211,17 +632,46 @@ def get_model_name(meter_model):
     return MODEL_NAMES.get(meter_model.lower().replace('.', '_'))
 
 
+def get_next_date(metric_type, last_date, report_day=31):
+    """
+    Дата, начиная с которой у прибора появятся данные после last_date
+    """
+    next_date = last_date + delta(metric_type)
+
+    if MONTH in metric_type:
+        next_date = get_report_date(next_date, report_day)
+
+    return next_date
+
+
+def get_period_boundary(metric_type, moment, report_day=31):
+    """
+    Ближайшая после moment граница периода, на которой у прибора появляется новая запись:
+    начало следующего часа, следующих суток или ближайший расчетный день
+    """
+    if HOUR in metric_type:
+        boundary = moment.replace(minute=0, second=0, microsecond=0)
+    elif DAY in metric_type:
+        boundary = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        boundary = get_report_date(moment, report_day)
+
+    if boundary <= moment:
+        boundary = get_next_date(metric_type, boundary, report_day)
+
+    return boundary
+
+
 def check_next_date(func):
     async def wrapper(self, metric_type, last_date):
         if last_date and CURRENT not in metric_type:
-            next_date = last_date + delta(metric_type)
+            report_day = 31
 
             if MONTH in metric_type:
                 scheme = await self.get_scheme()
                 report_day = scheme.get('report_day', 31)
-                next_date = get_report_date(next_date, report_day)
 
-            if next_date > now():
+            if get_next_date(metric_type, last_date, report_day) > now():
                 return
 
         return await func(self, metric_type, last_date)
@@ -229,52 +679,71 @@ def check_next_date(func):
     return wrapper
 
 
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(MSGPACK_DATETIME, obj.isoformat().encode())
+
+    raise TypeError(f'Unknown type: {obj!r}')
+
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_DATETIME:
+        return datetime.fromisoformat(data.decode())
+
+    return msgpack.ExtType(code, data)
+
+
+def pack(value):
+    return msgpack.packb(value, use_bin_type=True, default=_msgpack_default)
+
+
+def unpack(raw):
+    return msgpack.unpackb(raw, raw=False, ext_hook=_msgpack_ext_hook)
+
+
 class WaitResponse:
 
     def __init__(self, key, expire=90):
         self.__redis = None
 
         self.key = key
+        self.response_key = f'{key}:response'
+        self.released_key = f'{key}:released'
         self._expire = expire
 
     async def __aenter__(self):
-        self.__redis = await aioredis.create_redis('redis://partner-redis/1')
+        self.__redis = await redis_pools.get(REDIS_RESPONSE_DB)
+        attempt = 0
 
         while not await self.__redis.set(
-                self.key, pickle.dumps(None), expire=self._expire, exist=self.__redis.SET_IF_NOT_EXIST):
-            await asyncio.sleep(1)
+                self.key, pack(None), expire=self._expire, exist=self.__redis.SET_IF_NOT_EXIST):
+            if not await wait_signal(self.released_key, lock_backoff(attempt), db=REDIS_RESPONSE_DB):
+                attempt += 1
+
+        await self.__redis.delete(self.response_key)
 
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.__redis.delete(self.key)
-
-        self.__redis.close()
-        await self.__redis.wait_closed()
+        await self.__redis.eval(
+            RELEASE_RESPONSE_SCRIPT,
+            keys=[self.key, self.response_key, self.released_key],
+            args=[LOCK_SIGNAL_TTL]
+        )
 
     @classmethod
-    async def set_response(cls, key, value):
-        redis = await aioredis.create_redis('redis://partner-redis/1')
-
-        await redis.set(key, pickle.dumps({'response': value}), exist=redis.SET_IF_EXIST)
+    async def set_response(cls, key, value, expire=90):
+        redis = await redis_pools.get(REDIS_RESPONSE_DB)
 
-        redis.close()
-        await redis.wait_closed()
+        await redis.eval(SET_RESPONSE_SCRIPT, keys=[key, f'{key}:response'], args=[pack({'response': value}), expire])
 
     async def get_response(self, _timeout=60):
-        async with timeout(_timeout):
-            while True:
-                await asyncio.sleep(1)
-
-                resp = await self.__redis.get(self.key)
-
-                if not resp:
-                    continue
+        resp = await wait_signal(self.response_key, _timeout, db=REDIS_RESPONSE_DB)
 
-                resp = pickle.loads(resp)
+        if not resp:
+            raise asyncio.TimeoutError()
 
-                if resp:
-                    return resp.get('response')
+        return unpack(resp[1]).get('response')
 
 
 class NotAllParamsSetException(Exception):